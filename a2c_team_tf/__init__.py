@@ -48,4 +48,9 @@ register(
 register(
     id='DualDoors-v0',
     entry_point='a2c_team_tf.envs.team_grid_mult:DualDoors'
-)
\ No newline at end of file
+)
+
+register(
+    id='CartPole-team-v0',
+    entry_point='a2c_team_tf.envs.cartpole_ma:CartPoleTeam'
+)
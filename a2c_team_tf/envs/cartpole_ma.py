@@ -4,10 +4,15 @@
     truely multiagent environment with different capabilities.
 """
 import math
+import gym
+import numpy as np
+from gym import spaces
 from gym.envs.classic_control.cartpole import CartPoleEnv
 
 
 class CartPoleDefault(CartPoleEnv):
+    step_reward = -1.0
+
     def __init__(self):
         super().__init__()
         #self.theta_threshold_radians = 17 * 2 * math.pi / 360
@@ -16,12 +21,141 @@ class CartPoleDefault(CartPoleEnv):
 
     def step(self, action):
         state, _, done, info = CartPoleEnv.step(self, action)
-        return state, -1, done, info
+        return state, self.step_reward, done, info
 
 
 class CartPoleHeavyLong(CartPoleEnv):
+    step_reward = 1.0
+
     def __init__(self):
         super().__init__()
         self.theta_threshold_radians = 17 * 2 * math.pi / 360
         self.masscart = 1.0
-        self.length = 0.5
\ No newline at end of file
+        self.length = 0.5
+
+class CartPoleBatch:
+    """
+    N carts integrated together with NumPy (the gym CartPoleEnv dynamics, euler integration). Each cart
+    has its own masscart, length and theta_threshold_radians, so carts of different capabilities,
+    e.g. one per agent, are stepped in one call. Every cart is reset automatically when it fails, the
+    returned observation is then the cart's new initial state and info['terminal_observation'] holds
+    the state it failed in.
+    """
+
+    def __init__(self, num_envs, masscart=1.0, length=0.5, theta_threshold_radians=12 * 2 * math.pi / 360,
+                 masspole=0.1, force_mag=10.0, tau=0.02, x_threshold=2.4, reward=-1.0, seed=None):
+        """
+        :param num_envs: the number of carts
+        :param masscart, length, theta_threshold_radians, masspole, force_mag, x_threshold, reward:
+            scalars or per cart arrays of shape (num_envs,)
+        :param reward: the reward of each step, -1 as in CartPoleDefault
+        """
+        self.num_envs = num_envs
+        shape = (num_envs,)
+        self.gravity = 9.8
+        self.masscart = np.broadcast_to(np.asarray(masscart, dtype=np.float64), shape)
+        self.masspole = np.broadcast_to(np.asarray(masspole, dtype=np.float64), shape)
+        self.length = np.broadcast_to(np.asarray(length, dtype=np.float64), shape)  # half the pole's length
+        self.theta_threshold_radians = np.broadcast_to(np.asarray(theta_threshold_radians, dtype=np.float64), shape)
+        self.force_mag = np.broadcast_to(np.asarray(force_mag, dtype=np.float64), shape)
+        self.x_threshold = np.broadcast_to(np.asarray(x_threshold, dtype=np.float64), shape)
+        self.reward = np.broadcast_to(np.asarray(reward, dtype=np.float32), shape)
+        self.tau = tau
+        self.total_mass = self.masspole + self.masscart
+        self.polemass_length = self.masspole * self.length
+        self.action_space = spaces.Discrete(2)
+        self.np_random = np.random.RandomState(seed)
+        self.state = np.zeros((num_envs, 4))
+
+    @classmethod
+    def from_envs(cls, envs, reward=None, seed=None):
+        """
+        One cart per scalar CartPoleEnv, e.g. [CartPoleDefault(), CartPoleHeavyLong()], copying its parameters
+        :param reward: the reward of each step, a scalar or one per env. By default the step_reward attribute
+            of each env, envs without one must be given a reward
+        """
+        # gym.make wraps the envs, read the parameters of the underlying env
+        envs = [e.unwrapped for e in envs]
+        params = {k: [getattr(e, k) for e in envs] for k in (
+            'masscart', 'length', 'theta_threshold_radians', 'masspole', 'force_mag', 'x_threshold')}
+        if reward is None:
+            missing = [type(e).__name__ for e in envs if not hasattr(e, 'step_reward')]
+            if missing:
+                raise ValueError(f"No step_reward attribute on {', '.join(missing)}, pass reward= to from_envs")
+            reward = [e.step_reward for e in envs]
+        return cls(len(envs), reward=reward, seed=seed, tau=envs[0].tau, **params)
+
+    def seed(self, seed=None):
+        self.np_random = np.random.RandomState(seed)
+
+    def reset(self, mask: np.ndarray = None) -> np.ndarray:
+        """Resets the carts in mask (all carts if None), returns the states of all carts (N, 4)"""
+        mask = np.ones(self.num_envs, dtype=bool) if mask is None else mask
+        self.state[mask] = self.np_random.uniform(low=-0.05, high=0.05, size=(int(np.sum(mask)), 4))
+        return self.state.astype(np.float32)
+
+    def step(self, actions: np.ndarray):
+        """
+        :param actions: one action per cart, shape: (N,)
+        :return: states (N, 4), rewards (N,), dones (N,), info
+        """
+        x, x_dot, theta, theta_dot = self.state.T
+        force = np.where(np.asarray(actions) == 1, self.force_mag, -self.force_mag)
+        costheta = np.cos(theta)
+        sintheta = np.sin(theta)
+        temp = (force + self.polemass_length * theta_dot ** 2 * sintheta) / self.total_mass
+        thetaacc = (self.gravity * sintheta - costheta * temp) / (
+            self.length * (4.0 / 3.0 - self.masspole * costheta ** 2 / self.total_mass))
+        xacc = temp - self.polemass_length * thetaacc * costheta / self.total_mass
+        self.state = np.stack([
+            x + self.tau * x_dot,
+            x_dot + self.tau * xacc,
+            theta + self.tau * theta_dot,
+            theta_dot + self.tau * thetaacc], axis=1)
+        x, theta = self.state[:, 0], self.state[:, 2]
+        dones = (np.abs(x) > self.x_threshold) | (np.abs(theta) > self.theta_threshold_radians)
+        info = {"terminal_observation": self.state.astype(np.float32)}
+        if dones.any():
+            self.reset(dones)
+        return self.state.astype(np.float32), self.reward.copy(), dones, info
+
+
+class CartPoleTeam(gym.Env):
+    """
+    A team env for MTARL/ParallelEnv with one cart per agent, all integrated by a CartPoleBatch.
+    Like the team grid envs the observations and rewards are lists over the agents, done is always
+    False (the xDFAs decide when the episode is over) and the episode is limited by max_steps. A failed
+    cart restarts from a new initial state while the episode continues, the xDFAs can read the
+    states it failed in from env.state and env.failed.
+    """
+
+    def __init__(self, num_agents=2, max_steps=200, **cart_kwargs):
+        """
+        :param cart_kwargs: the CartPoleBatch parameters, scalars or one value per agent,
+            e.g. theta_threshold_radians=[12 * 2 * math.pi / 360, 17 * 2 * math.pi / 360]
+        """
+        self.carts = CartPoleBatch(num_agents, **cart_kwargs)
+        self.num_agents = num_agents
+        self.max_steps = max_steps
+        self.step_count = 0
+        self.action_space = self.carts.action_space
+        self.observation_space = spaces.Box(-np.inf, np.inf, (4,), dtype=np.float32)
+        # the last states and cart failures of the agents, (agents, 4) and (agents,)
+        self.state = None
+        self.failed = np.zeros(num_agents, dtype=bool)
+
+    def seed(self, seed=None):
+        self.carts.seed(seed)
+        return [seed]
+
+    def reset(self):
+        self.step_count = 0
+        self.failed = np.zeros(self.num_agents, dtype=bool)
+        self.state = self.carts.reset()
+        return list(self.state)
+
+    def step(self, actions):
+        self.step_count += 1
+        obs, rewards, self.failed, info = self.carts.step(np.asarray(actions).reshape(-1))
+        self.state = info["terminal_observation"]
+        return list(obs), list(rewards), False, info
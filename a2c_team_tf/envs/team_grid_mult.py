@@ -19,15 +19,26 @@ class BaseEnv(MiniGridEnv):
     objects in that they infinitely resupply, rewards are negative, done is
     always false as it is up to the DFAs to decide when the epsiode is over.
 
-    Note: This environment is deceptively difficult to learn becuase it is actually dynamic"""
+    Note: This environment is deceptively difficult to learn becuase it is actually dynamic
 
-    def __init__(self, num_agents=2, gridsize=None, max_steps=100, width=None, height=None):
+    With flatten_obs=False the observations are the encoded uint8 grids of shape (width, height, 3)
+    instead of flat vectors, e.g. for the convolutional encoder in a2c_team_tf/nets/base.py
+
+    By default every agent sees the whole grid. With agent_view_size, e.g. 7, each agent gets the
+    egocentric (view, view, 3) grid in front of it instead, so the observation size no longer grows
+    with the grid area. Set see_through_walls=False to also hide the cells behind walls and doors"""
+
+    def __init__(self, num_agents=2, gridsize=None, max_steps=100, width=None, height=None, flatten_obs=True,
+                 agent_view_size=None, see_through_walls=True):
         self.num_agents = num_agents
+        self.flatten_obs = flatten_obs
+        if agent_view_size is None:
+            agent_view_size = gridsize if gridsize else max(height, width)
 
         super().__init__(
             grid_size=gridsize,
-            agent_view_size=gridsize if gridsize else max(height, width),
-            see_through_walls=True,
+            agent_view_size=agent_view_size,
+            see_through_walls=see_through_walls,
             max_steps=max_steps,
             width=width,
             height=height
@@ -78,24 +89,26 @@ class BaseEnv(MiniGridEnv):
 
         obs_ = []
         for img in obs:
-            obs_.append(img.flatten())
+            obs_.append(img.flatten() if self.flatten_obs else img)
         return obs_, rewards, False, {}
 
     def reset(self):
         obs = MiniGridEnv.reset(self)
         obs_ = []
         for img in obs:
-            obs_.append(img.flatten())
+            obs_.append(img.flatten() if self.flatten_obs else img)
         return obs_
 
 
 class TestEnv(BaseEnv):
 
-    def __init__(self, numKeys=2, numBalls=2, numBoxes=1, max_steps=15):
+    def __init__(self, numKeys=2, numBalls=2, numBoxes=1, max_steps=15, flatten_obs=True, agent_view_size=None,
+                 see_through_walls=True):
         self.num_keys = numKeys
         self.num_balls = numBalls
         self.num_boxes = numBoxes
-        super(TestEnv, self).__init__(max_steps=max_steps, gridsize=6)
+        super(TestEnv, self).__init__(max_steps=max_steps, gridsize=6, flatten_obs=flatten_obs,
+                                      agent_view_size=agent_view_size, see_through_walls=see_through_walls)
 
     def _gen_grid(self, width, height):
         # instantiate the grid
@@ -120,11 +133,13 @@ class TestEnv(BaseEnv):
 
 class TestEnv2(BaseEnv):
 
-    def __init__(self, numKeys=2, numBalls=2, numBoxes=1, max_steps=30):
+    def __init__(self, numKeys=2, numBalls=2, numBoxes=1, max_steps=30, flatten_obs=True, agent_view_size=None,
+                 see_through_walls=True):
         self.num_keys = numKeys
         self.num_balls = numBalls
         self.num_boxes = numBoxes
-        super(TestEnv2, self).__init__(max_steps=max_steps, width=12, height=7)
+        super(TestEnv2, self).__init__(max_steps=max_steps, width=12, height=7, flatten_obs=flatten_obs,
+                                       agent_view_size=agent_view_size, see_through_walls=see_through_walls)
 
     def _gen_grid(self, width, height):
         # instantiate the grid
@@ -158,8 +173,9 @@ class TestEnv2(BaseEnv):
         self.toggled = False
 
 class DualDoors(BaseEnv):
-    def __init__(self):
-        super(DualDoors, self).__init__(width=19, height=11, max_steps=250, gridsize=None)
+    def __init__(self, flatten_obs=True, agent_view_size=None, see_through_walls=True):
+        super(DualDoors, self).__init__(width=19, height=11, max_steps=250, gridsize=None, flatten_obs=flatten_obs,
+                                        agent_view_size=agent_view_size, see_through_walls=see_through_walls)
 
 
     def _gen_grid(self, width, height):
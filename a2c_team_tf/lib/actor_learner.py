@@ -0,0 +1,100 @@
+# Decouples rollout collection from the gradient updates of MTARL
+# An actor thread keeps collecting batches with a recent copy of the model weights while the
+# learner consumes them, correcting for the policy lag with V-trace (see MTARL.train_vtrace)
+
+import queue
+import threading
+import tensorflow as tf
+from typing import List
+from a2c_team_tf.lib.tf2_a2c_base_v2 import MTARL
+
+
+class ActorLearner:
+    """
+    Runs MTARL.collect_batch in an actor thread which fills a bounded trajectory queue.
+    The learner calls step to consume one trajectory and update the learner models.
+
+    The actor acts with its own copy of the models (same architecture as the learner models)
+    and picks up the learner weights before each rollout whenever they have been updated,
+    so environment workers never wait on backprop. The queue bound limits how stale a
+    trajectory can be, at most queue_size + 1 learner updates.
+    """
+
+    def __init__(self, agent: MTARL, learner_models: List[tf.keras.Model],
+                 actor_models: List[tf.keras.Model], initial_state: tf.Tensor,
+                 log_reward: tf.Tensor, queue_size=2):
+        """
+        :param agent: the MTARL agent whose environments are used for collection
+        :param learner_models: the models which are trained
+        :param actor_models: copies of the learner models used for acting, they must be built
+        :param initial_state: initial states across the sample environments, shape: (A, S, 1, F)
+        :param log_reward: logging helper tensor of the current episode rewards, shape: (A, S, tasks + 1)
+        :param queue_size: the maximum number of trajectories waiting for the learner
+        """
+        self.agent = agent
+        self.learner_models = learner_models
+        self.actor_models = actor_models
+        self.state = initial_state
+        self.log_reward = log_reward
+        self.trajectories = queue.Queue(maxsize=queue_size)
+        self.lock = threading.Lock()
+        self.weights = None
+        self.stop_event = threading.Event()
+        self.error = None
+        self.publish_weights()
+        self.thread = threading.Thread(target=self.actor_loop, daemon=True)
+
+    def publish_weights(self):
+        """Makes the current learner weights available to the actor"""
+        weights = [m.get_weights() for m in self.learner_models]
+        with self.lock:
+            self.weights = weights
+
+    def sync_actor(self):
+        with self.lock:
+            weights, self.weights = self.weights, None
+        if weights is not None:
+            for model, w in zip(self.actor_models, weights):
+                model.set_weights(w)
+
+    def actor_loop(self):
+        try:
+            while not self.stop_event.is_set():
+                self.sync_actor()
+                trajectory = self.agent.collect_batch(self.state, self.log_reward, *self.actor_models)
+                self.state, self.log_reward = trajectory[5], trajectory[7]
+                # block while the queue is full, checking periodically for a stop request
+                while not self.stop_event.is_set():
+                    try:
+                        self.trajectories.put(trajectory, timeout=0.1)
+                        break
+                    except queue.Full:
+                        continue
+        except Exception as e:
+            self.error = e
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        self.thread.join()
+
+    def step(self, mu: tf.Tensor):
+        """
+        Consumes one trajectory from the queue and makes a V-trace learner update
+        :param mu: the task allocation probabilities, shape: (agents, tasks)
+        :return: running_rewards, loss, ini_values
+        """
+        while True:
+            if self.error is not None:
+                raise self.error
+            try:
+                trajectory = self.trajectories.get(timeout=0.1)
+                break
+            except queue.Empty:
+                continue
+        loss, ini_values = self.agent.train_vtrace(trajectory, mu, *self.learner_models)
+        self.publish_weights()
+        running_rewards = trajectory[6]
+        return running_rewards, loss, ini_values
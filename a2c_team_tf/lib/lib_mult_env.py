@@ -4,6 +4,9 @@ import tensorflow as tf
 from tensorflow import Variable
 
 from a2c_team_tf.utils.dfa import CrossProductDFA
+from a2c_team_tf.lib.sampling import sample_actions
+from a2c_team_tf.utils.obs_buffer import ObsAssembler
+from a2c_team_tf.utils.recorder import EpisodeRecorder, multi_env_episode
 from typing import List, Tuple, Union, Any
 from enum import Enum
 
@@ -17,7 +20,13 @@ class Agent:
             dfas: List[CrossProductDFA],
             c, e, chi, lam, gamma,
             one_off_reward,
-            num_tasks, num_agents, lr1=1e-4, lr2=1e-4):
+            num_tasks, num_agents, lr1=1e-4, lr2=1e-4, gumbel_sampling=False, num_envs=1):
+        """
+        :param envs: one env per agent, or when num_envs > 1 a list per agent of num_envs envs or
+            one vectorised env per agent with a num_envs attribute, e.g. CartPoleBatch
+        :param dfas: one xDFA per agent, or when num_envs > 1 a list per agent of num_envs xDFAs
+        :param num_envs: the number of envs each agent drives in lockstep, see train_step_batch
+        """
         self.envs = envs
         self.e, self.c, self.chi, self.lam = e, c, chi, lam
         self.gamma = gamma
@@ -31,36 +40,83 @@ class Agent:
         self.one_off_reward = one_off_reward
         self.opt = tf.keras.optimizers.Adam(learning_rate=lr1)
         self.huber = tf.keras.losses.Huber(reduction=tf.keras.losses.Reduction.SUM)
-
-    def env_step(self, action: np.ndarray, agent: np.int32) -> Tuple[
-        np.ndarray, np.ndarray, np.ndarray]:
-        """Returns state, reward and done flag given an action."""
-
-        state_new, step_reward, done, _ = self.envs[agent].step(action)
+        self.gumbel_sampling = gumbel_sampling
+        self.num_envs = num_envs
+        # batched view of the envs, a list per agent of num_envs (env, xDFA) pairs
+        if num_envs > 1:
+            self.batch_envs, self.batch_dfas = envs, dfas
+        else:
+            self.batch_envs, self.batch_dfas = [[e] for e in envs], [[d] for d in dfas]
+        # last observation of each batched env, assembled in place, and whether its episode is still running
+        self.batch_obs = [ObsAssembler(num_envs) for _ in range(num_agents)]
+        self.batch_active = [np.zeros(num_envs, dtype=bool) for _ in range(num_agents)]
+        # each agent's envs are stepped together by a single vectorised env
+        self.vec_envs = num_envs > 1 and hasattr(envs[0], 'num_envs')
+
+    def step_env(self, agent, n, action) -> Tuple[np.ndarray, np.ndarray, bool]:
+        """
+        Steps the n-th env of an agent and its xDFA
+        :return: the state with the xDFA progress (a view of the agent's observation buffer), rewards and done
+        """
+        env, dfa = self.batch_envs[agent][n], self.batch_dfas[agent][n]
+        state_new, step_reward, done, _ = env.step(action)
 
         ## Get a one-off reward when reaching the position threshold for the first time.
         # update the task xDFA
         data = {"state": state_new, "reward": step_reward, "done": done}
-        self.dfas[agent].next(data)
-        # print("state", state_new)
-        # if agent == 1:
-        #     print(f"agent ({agent}) ", self.dfas[agent].progress)
+        dfa.next(data)
 
         # agent-task rewards
-        task_rewards = self.dfas[agent].rewards(self.one_off_reward)
+        task_rewards = dfa.rewards(self.one_off_reward)
         state_task_rewards = [step_reward] + task_rewards
         # append the dfa state to the agent state
-        state_ = np.append(state_new, np.array(self.dfas[agent].progress))
+        state_ = self.batch_obs[agent].assemble_row(n, state_new, dfa)
+        return state_, np.array(state_task_rewards, np.float32), dfa.done()
 
-        if self.dfas[agent].done():
-            done = True
-        else:
-            done = False
+    def env_step(self, action: np.ndarray, agent: np.int32) -> Tuple[
+        np.ndarray, np.ndarray, np.ndarray]:
+        """Returns state, reward and done flag given an action."""
+        state_, rewards, done = self.step_env(agent, 0, action)
+        # copied, numpy_function outputs may share memory with the returned array
+        return state_.copy(), rewards, np.array(done, np.int32)
 
-        return (state_.astype(np.float32),
-                # np.array(step_reward, np.int32),
-                np.array(state_task_rewards, np.float32),
-                np.array(done, np.int32))
+    def env_step_batch(self, actions: np.ndarray, agent: np.int32) -> Tuple[
+        np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Steps each of the agent's envs which is still running its episode. Finished envs are not
+        stepped again (there is no auto-reset), they repeat their last state with zero rewards
+        and done = 1.
+        :param actions: one action per env, shape: (N,)
+        :return: states (N, F), rewards (N, tasks + 1), dones (N,)
+        """
+        if self.vec_envs:
+            return self.vec_env_step(actions, agent)
+        active = self.batch_active[agent]
+        rewards = np.zeros((self.num_envs, self.num_tasks + 1), dtype=np.float32)
+        for n in np.flatnonzero(active):
+            _, rewards[n], done = self.step_env(agent, n, actions[n])
+            active[n] = not done
+        return self.batch_obs[agent].buffer.copy(), rewards, np.logical_not(active).astype(np.int32)
+
+    def vec_env_step(self, actions: np.ndarray, agent: np.int32) -> Tuple[
+        np.ndarray, np.ndarray, np.ndarray]:
+        """
+        env_step_batch for a vectorised env. All of its envs are stepped in one call, the envs which
+        already finished are reset by the vectorised env and their results are ignored.
+        """
+        active = self.batch_active[agent]
+        rewards = np.zeros((self.num_envs, self.num_tasks + 1), dtype=np.float32)
+        states, step_rewards, dones, info = self.batch_envs[agent].step(actions)
+        # the xDFAs see the state an env failed in rather than its auto-reset state
+        terminal = info.get("terminal_observation", states)
+        for n in np.flatnonzero(active):
+            dfa = self.batch_dfas[agent][n]
+            dfa.next({"state": terminal[n], "reward": step_rewards[n], "done": dones[n]})
+            rewards[n, 0] = step_rewards[n]
+            rewards[n, 1:] = dfa.rewards(self.one_off_reward)
+            self.batch_obs[agent].assemble_row(n, states[n], dfa)
+            active[n] = not dfa.done()
+        return self.batch_obs[agent].buffer.copy(), rewards, np.logical_not(active).astype(np.int32)
 
     def render_episode(self, max_steps, *models):
         initial_state = self.get_initial_states()
@@ -73,22 +129,74 @@ class Agent:
                 self.envs[i].render('human')
                 state_ = tf.expand_dims(state[i], 0)
                 action_logits, _ = model(state_)
-                action = tf.random.categorical(action_logits, 1)[0, 0]
+                action, _, _ = sample_actions(action_logits, gumbel=self.gumbel_sampling)
+                action = action[0]
                 state_i, _, done = self.tf_env_step(action, i)
                 dones.append(tf.cast(done, tf.bool).numpy())
                 state[i] = state_i
             if all(dones):
                 break
 
+    def record_episode(self, recorder: EpisodeRecorder, name: str, max_steps, *models) -> bool:
+        """
+        Off-screen alternative to render_episode, an episode of the first env of each agent is recorded by
+        a background process from a snapshot of the models and written to {recorder.directory}/{name}.npz
+        :return: whether the recording was started, it is skipped while the previous one is running
+        """
+        if self.vec_envs:
+            raise ValueError(f"Episodes cannot be recorded from vectorised envs, got a {type(self.envs[0]).__name__} "
+                             f"per agent with num_envs={self.num_envs}, pass a list of envs per agent instead")
+        envs = [e[0] for e in self.batch_envs]
+        dfas = [d[0] for d in self.batch_dfas]
+        # the observation buffers are only allocated by the first reset
+        input_shape = (1, int(np.prod(envs[0].observation_space.shape)) + len(dfas[0].dfas))
+        return recorder.record(multi_env_episode, envs, dfas, models, input_shape, name, max_steps)
+
     def env_reset(self, agent):
         state = self.envs[agent].reset()
         self.dfas[agent].reset()
-        initial_state = np.append(state, np.array(self.dfas[agent].progress, dtype=np.float32))
-        return initial_state
+        # the batched view is kept in sync so that lockstep episodes can step this env
+        initial_state = self.batch_obs[agent].assemble_row(0, state, self.dfas[agent])
+        self.batch_active[agent][:] = True
+        return initial_state.copy()
 
     def tf_reset(self, agent: tf.int32):
         return tf.numpy_function(self.env_reset, [agent], [tf.float32])
 
+    def env_reset_batch(self, agent):
+        if self.vec_envs:
+            states = self.batch_envs[agent].reset()
+            [dfa.reset() for dfa in self.batch_dfas[agent]]
+            self.batch_active[agent][:] = True
+            return self.batch_obs[agent].assemble(states, self.batch_dfas[agent]).copy()
+        states = []
+        for env, dfa in zip(self.batch_envs[agent], self.batch_dfas[agent]):
+            states.append(env.reset())
+            dfa.reset()
+        self.batch_active[agent][:] = True
+        return self.batch_obs[agent].assemble(states, self.batch_dfas[agent]).copy()
+
+    def get_initial_states_batch(self):
+        """Resets every batched env, returns the initial states of shape (agents, N, F)"""
+        initial_states = tf.TensorArray(dtype=tf.float32, size=self.num_agents)
+        for agent in tf.range(self.num_agents):
+            init_state_i = tf.numpy_function(self.env_reset_batch, [agent], tf.float32)
+            initial_states = initial_states.write(agent, init_state_i)
+        initial_states = initial_states.stack()
+        return initial_states
+
+    def env_step_all(self, actions: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Steps the envs of every agent, see env_step_batch
+        :param actions: shape: (agents, N)
+        :return: states (agents, N, F), rewards (agents, N, tasks + 1), dones (agents, N)
+        """
+        states, rewards, dones = zip(*[self.env_step_batch(actions[i], i) for i in range(self.num_agents)])
+        return np.stack(states), np.stack(rewards), np.stack(dones)
+
+    def tf_env_step_all(self, actions: tf.Tensor) -> List[tf.Tensor]:
+        return tf.numpy_function(self.env_step_all, [actions], [tf.float32, tf.float32, tf.int32])
+
     def get_initial_states(self):
         initial_states = tf.TensorArray(dtype=tf.float32, size=self.num_agents)
         for agent in tf.range(self.num_agents):
@@ -114,7 +222,8 @@ class Agent:
         # Start from the end of rewards and accumulate reward sums into the returns array
         rewards = tf.cast(rewards[::-1], dtype=tf.float32)
 
-        discounted_sum = tf.constant([0.0] * (self.num_tasks + 1), dtype=tf.float32)
+        # (tasks + 1,) for a single episode or (N, tasks + 1) for batched episodes
+        discounted_sum = tf.zeros_like(rewards[0])
         discounted_sum_shape = discounted_sum.shape
         for i in tf.range(n):
             reward = rewards[i]
@@ -178,7 +287,7 @@ class Agent:
 
     def compute_loss(
             self,
-            action_probs: tf.Tensor,
+            action_log_probs: tf.Tensor,
             values: tf.Tensor,
             returns: tf.Tensor,
             ini_value: tf.Tensor,
@@ -189,7 +298,6 @@ class Agent:
 
         H = self.compute_H(ini_value, ini_values_i, agent, mu)
         advantage = tf.matmul(returns - values, H)
-        action_log_probs = tf.math.log(action_probs)
         actor_loss = -tf.math.reduce_sum(action_log_probs * advantage)
 
         critic_loss = huber_loss(values, returns)
@@ -203,7 +311,7 @@ class Agent:
             model: tf.keras.Model):
         """Runs a single episode to collect training data."""
 
-        action_probs = tf.TensorArray(dtype=tf.float32, size=max_steps)
+        action_log_probs = tf.TensorArray(dtype=tf.float32, size=max_steps)
         values = tf.TensorArray(dtype=tf.float32, size=max_steps)
         rewards = tf.TensorArray(dtype=tf.float32, size=max_steps)
         mask = tf.TensorArray(dtype=tf.int32, size=max_steps)
@@ -217,15 +325,15 @@ class Agent:
             # Run the model and to get action probabilities and critic value
             action_logits_t, value = model(state1)
 
-            # Sample next action from the action probability distribution
-            action = tf.random.categorical(action_logits_t, 1)[0, 0]
-            action_probs_t = tf.nn.softmax(action_logits_t)
+            # Sample next action, and its log probability, from the action probability distribution
+            action, action_log_prob, _ = sample_actions(action_logits_t, gumbel=self.gumbel_sampling)
+            action = action[0]
 
             # Store critic values
             values = values.write(t, tf.squeeze(value))
 
             # Store log probability of the action chosen
-            action_probs = action_probs.write(t, action_probs_t[0, action])
+            action_log_probs = action_log_probs.write(t, action_log_prob[0])
 
             # Apply action to the environment to get next state and reward
             state, reward, done = self.tf_env_step(action, env_index)
@@ -238,49 +346,127 @@ class Agent:
             if tf.cast(done, tf.bool):
                 break
 
-        action_probs = action_probs.stack()
+        action_log_probs = action_log_probs.stack()
         values = values.stack()
         rewards = rewards.stack()
         mask = mask.stack()
-        return action_probs, values, rewards, mask
+        return action_log_probs, values, rewards, mask
+
+    def run_episodes(
+            self,
+            initial_states: tf.Tensor,
+            max_steps: tf.int32,
+            *models):
+        """
+        Runs the episodes of all agents, and each of their N envs, in the same loop. Every step makes one
+        batched model call per agent and a single env call which steps every env whose episode is still
+        running, so the wall time is that of the longest episode rather than the sum over the agents.
+        :param initial_states: shape: (agents, N, F)
+        :return: action_log_probs (agents, T, N), values (agents, T, N, tasks + 1),
+        rewards (agents, T, N, tasks + 1) and mask (agents, T, N) which is 1 while the env's episode is running
+        """
+        action_log_probs = tf.TensorArray(dtype=tf.float32, size=max_steps)
+        values = tf.TensorArray(dtype=tf.float32, size=max_steps)
+        rewards = tf.TensorArray(dtype=tf.float32, size=max_steps)
+        mask = tf.TensorArray(dtype=tf.int32, size=max_steps)
+        initial_states_shape = initial_states.shape
+        states = initial_states
+        running = tf.ones([self.num_agents, self.num_envs], dtype=tf.int32)
+
+        for t in tf.range(max_steps):
+            actions_t, log_probs_t, values_t = [], [], []
+            for i, model in enumerate(models):
+                action_logits_i, value_i = model(states[i])
+                action_i, log_prob_i, _ = sample_actions(action_logits_i, gumbel=self.gumbel_sampling)
+                actions_t.append(action_i)
+                log_probs_t.append(log_prob_i)
+                values_t.append(value_i)
+
+            values = values.write(t, tf.stack(values_t))
+            action_log_probs = action_log_probs.write(t, tf.stack(log_probs_t))
+
+            states, reward, done = self.tf_env_step_all(tf.stack(actions_t))
+            states.set_shape(initial_states_shape)
+            done.set_shape([self.num_agents, self.num_envs])
+
+            rewards = rewards.write(t, reward)
+            mask = mask.write(t, running)
+            running = running * (1 - done)
+
+            if tf.equal(tf.reduce_sum(running), 0):
+                break
+
+        action_log_probs = tf.transpose(action_log_probs.stack(), [1, 0, 2])
+        values = tf.transpose(values.stack(), [1, 0, 2, 3])
+        rewards = tf.transpose(rewards.stack(), [1, 0, 2, 3])
+        mask = tf.transpose(mask.stack(), [1, 0, 2])
+        return action_log_probs, values, rewards, mask
 
     @tf.function
-    def train_step(
+    def train_step_batch(
             self,
             initial_states: tf.Tensor,
             max_steps_per_episode: tf.int32,
             mu: tf.Tensor,
             *models) -> [tf.Tensor, tf.Tensor]:
+        """
+        Batched version of train_step where each agent runs num_envs episodes. The loss of each episode
+        is computed as in train_step and averaged over the envs. The losses of all of an agent's envs are
+        computed together on the (T, N) batch, the steps after an env's episode finished are masked out,
+        so the size of the graph does not depend on N.
+        :param initial_states: from get_initial_states_batch, shape: (agents, N, F)
+        :return: rewards (agents, T, N, tasks + 1), initial values averaged over the envs (agents, tasks + 1)
+        """
+        with tf.GradientTape() as tape:
+            action_log_probs_l, values_l, rewards_l, masks_l = self.run_episodes(
+                initial_states, max_steps_per_episode, *models)
+            returns_l = tf.stack([self.get_expected_returns(rewards_l[i]) for i in range(self.num_agents)])
+            ini_values = tf.reduce_mean(values_l[:, 0], axis=1)
+
+            loss_l = tf.TensorArray(dtype=tf.float32, size=0, dynamic_size=True)
 
-        action_probs_l = tf.TensorArray(dtype=tf.float32, size=self.num_agents)
-        values_l = tf.TensorArray(dtype=tf.float32, size=self.num_agents)
-        rewards_l = tf.TensorArray(dtype=tf.float32, size=self.num_agents)
-        returns_l = tf.TensorArray(dtype=tf.float32, size=self.num_agents)
-        masks_l = tf.TensorArray(dtype=tf.int32, size=self.num_agents)
+            for i in tf.range(self.num_agents):
+                # H depends on the initial values only, so it is the same for each of the agent's envs
+                H = self.compute_H(ini_values, ini_values[i], i, mu)
+                mask = tf.cast(masks_l[i], tf.float32)  # (T, N)
+                advantage = tf.squeeze(tf.tensordot(returns_l[i] - values_l[i], H, axes=1), 2) * mask
+                log_probs = action_log_probs_l[i] * mask
+                # the actor loss of an episode in compute_loss, (T,) log probs times (T, 1) advantages, sums
+                # the products of all pairs of steps, i.e. the sum of the log probs times the sum of the advantages
+                actor_loss = -tf.math.reduce_sum(tf.math.reduce_sum(log_probs, 0) * tf.math.reduce_sum(advantage, 0))
+                critic_loss = huber_loss(values_l[i], returns_l[i], sample_weight=mask)
+                loss_l = loss_l.write(i, (actor_loss - critic_loss) / self.num_envs)
+            loss_l = loss_l.stack()
+        vars_l = [m.trainable_variables for m in models]
+        grads_l = tape.gradient(loss_l, vars_l)
+
+        grads_l_f = [x for y in grads_l for x in y]
+        vars_l_f = [x for y in vars_l for x in y]
+        self.opt.apply_gradients(zip(grads_l_f, vars_l_f))
+
+        return rewards_l, ini_values
 
-        idx = tf.constant(0, dtype=tf.int32)
+    @tf.function
+    def train_step(
+            self,
+            initial_states: tf.Tensor,
+            max_steps_per_episode: tf.int32,
+            mu: tf.Tensor,
+            *models) -> [tf.Tensor, tf.Tensor]:
+        """
+        Runs one episode per agent, all agents advancing in lockstep (see run_episodes), and updates the models
+        :param initial_states: from get_initial_states, shape: (agents, F)
+        :return: rewards (agents, T, tasks + 1), initial values (agents, tasks + 1)
+        """
         with tf.GradientTape() as tape:
-            for model in models:
-                # Run an episode
-                action_probs, values, rewards, mask = self.run_episode(
-                    initial_states[idx], idx, max_steps_per_episode, model)
-
-                # Get expected rewards
-                returns = self.get_expected_returns(rewards)
-
-                # Append tensors to respective lists
-                action_probs_l = action_probs_l.write(idx, action_probs)
-                values_l = values_l.write(idx, values)
-                rewards_l = rewards_l.write(idx, rewards)
-                returns_l = returns_l.write(idx, returns)
-                masks_l = masks_l.write(idx, mask)
-                idx += tf.constant(1, dtype=tf.int32)
-
-            action_probs_l = action_probs_l.stack()
-            values_l = values_l.stack()
-            rewards_l = rewards_l.stack()
-            returns_l = returns_l.stack()
-            masks_l = masks_l.stack()
+            # a single env per agent is a batch of size one
+            action_log_probs_l, values_l, rewards_l, masks_l = self.run_episodes(
+                tf.expand_dims(initial_states, 1), max_steps_per_episode, *models)
+            action_log_probs_l = action_log_probs_l[:, :, 0]
+            values_l = values_l[:, :, 0]
+            rewards_l = rewards_l[:, :, 0]
+            masks_l = masks_l[:, :, 0]
+            returns_l = tf.stack([self.get_expected_returns(rewards_l[i]) for i in range(self.num_agents)])
             ini_values = values_l[:, 0, :]
 
             loss_l = tf.TensorArray(dtype=tf.float32, size=0, dynamic_size=True)
@@ -290,9 +476,9 @@ class Agent:
                 mask = masks_l[i]
                 _, values = tf.dynamic_partition(values_l[i], mask, 2)
                 _, returns = tf.dynamic_partition(returns_l[i], mask, 2)
-                _, probs = tf.dynamic_partition(action_probs_l[i], mask, 2)
+                _, log_probs = tf.dynamic_partition(action_log_probs_l[i], mask, 2)
                 ini_values_i = ini_values[i]
-                loss = self.compute_loss(probs, values, returns, ini_values, ini_values_i, i, mu)
+                loss = self.compute_loss(log_probs, values, returns, ini_values, ini_values_i, i, mu)
                 loss_l = loss_l.write(i, loss)
             loss_l = loss_l.stack()
         # compute the gradient from the loss vector
@@ -0,0 +1,38 @@
+import numpy as np
+import tensorflow as tf
+from typing import Tuple
+
+eps = np.finfo(np.float32).eps.item()
+
+
+def log_probs_entropy(action_logits: tf.Tensor, actions: tf.Tensor) -> Tuple[tf.Tensor, tf.Tensor]:
+    """
+    Log probabilities of the selected actions and the policy entropy for a batch of
+    categorical policies.
+    :param action_logits: logits of shape (..., env_action_space), e.g. (agents, samples, actions)
+    :param actions: selected actions of shape (...)
+    :return: log probabilities (...), entropy (...)
+    """
+    log_probs = tf.nn.log_softmax(action_logits)
+    action_log_probs = tf.reduce_sum(
+        tf.one_hot(actions, tf.shape(action_logits)[-1], dtype=log_probs.dtype) * log_probs, axis=-1)
+    entropy = -tf.reduce_sum(tf.exp(log_probs) * log_probs, axis=-1)
+    return action_log_probs, entropy
+
+
+def sample_actions(action_logits: tf.Tensor, gumbel: bool = False) -> Tuple[tf.Tensor, tf.Tensor, tf.Tensor]:
+    """
+    Samples one action for every policy in a batch of logits in a single op.
+    :param action_logits: logits of shape (..., env_action_space), e.g. (agents, samples, actions)
+    :param gumbel: sample with the Gumbel-max trick, argmax(logits + G), instead of tf.random.categorical
+    :return: actions (...), log probabilities of the actions (...), entropy (...)
+    """
+    if gumbel:
+        u = tf.random.uniform(tf.shape(action_logits), minval=eps, maxval=1.0, dtype=action_logits.dtype)
+        actions = tf.argmax(action_logits - tf.math.log(-tf.math.log(u)), axis=-1, output_type=tf.int32)
+    else:
+        flat_logits = tf.reshape(action_logits, [-1, tf.shape(action_logits)[-1]])
+        actions = tf.random.categorical(flat_logits, num_samples=1, dtype=tf.int32)
+        actions = tf.reshape(actions, tf.shape(action_logits)[:-1])
+    action_log_probs, entropy = log_probs_entropy(action_logits, actions)
+    return actions, action_log_probs, entropy
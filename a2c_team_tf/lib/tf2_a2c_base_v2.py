@@ -1,11 +1,21 @@
 import copy
+import time
 import numpy as np
+import gym
 from typing import Tuple, List
 import tensorflow as tf
 from a2c_team_tf.utils.parallel_envs_team import ParallelEnv
 from a2c_team_tf.utils.env_utils import make_env
+from a2c_team_tf.utils.obs_buffer import ObsAssembler
+from a2c_team_tf.utils.recorder import EpisodeRecorder, team_episode
+from a2c_team_tf.nets.base import MultiAgentModel, low_precision_dtypes
+from a2c_team_tf.lib.sampling import sample_actions, log_probs_entropy
 import tensorflow_probability as tfp
 
+# the mixed_precision options of MTARL and the compute dtype of the hidden layers of the models
+MIXED_PRECISION_DTYPES = {None: "float32", "mixed_float16": "float16", "mixed_bfloat16": "bfloat16"}
+
+
 class MTARL:
     def __init__(self, envs, num_agents,
                  num_tasks, xdfas, one_off_reward,
@@ -14,8 +24,15 @@ class MTARL:
                  seed=None, num_procs=10, num_frames_per_proc=100,
                  recurrence=1, max_eps_steps=100, env_key=None,
                  flatten_env=False, normalisation_coef=1.0, normalisation_coef2=1.0,
-                 reward_machine=False, shaped_rewards=False):
+                 reward_machine=False, shaped_rewards=False,
+                 entropy_coef=0.0, gumbel_sampling=False,
+                 ppo=False, ppo_epochs=4, num_minibatches=4, clip_eps=0.2,
+                 vtrace_rho_bar=1.0, vtrace_c_bar=1.0, jit_compile=False, mixed_precision=None,
+                 env_kwargs=None, obs_dtype=np.float32):
         self.num_agents = num_agents
+        # Compact observations, e.g. np.int8 for the team grid envs, are kept in obs_dtype from the envs
+        # through the rollout storage and only cast to float by the models, see ParallelEnv
+        self.obs_dtype = tf.as_dtype(obs_dtype)
         self.envs: ParallelEnv = ParallelEnv(
                 envs,
                 xdfas,
@@ -26,16 +43,33 @@ class MTARL:
                 seed,
                 0.9,
                 reward_machine,
-                shaped_rewards)
+                shaped_rewards,
+                obs_dtype)
         if env_key:
             self.renv = make_env(
                 env_key=env_key,
                 max_steps_per_episode=max_eps_steps,
                 seed=seed,
-                apply_flat_wrapper=flatten_env)
+                apply_flat_wrapper=flatten_env,
+                env_kwargs=env_kwargs)
+        self.render_obs = ObsAssembler(num_agents, obs_dtype)
         self.shaped_rewards = shaped_rewards
+        self.entropy_coef = entropy_coef
+        self.gumbel_sampling = gumbel_sampling
+        # PPO style clipped surrogate updates, several epochs of minibatch updates per collected batch
+        self.ppo = ppo
+        self.ppo_epochs = ppo_epochs
+        self.num_minibatches = num_minibatches
+        self.clip_eps = clip_eps
+        # V-trace importance weight truncation levels used by the decoupled actor-learner
+        self.vtrace_rho_bar = vtrace_rho_bar
+        self.vtrace_c_bar = vtrace_c_bar
         self.recurrent = recurrence > 1
         self.recurrence = recurrence
+        # LSTM (h, c) memories of shape (A, S, memory_size) carried across batches for recurrent models
+        self.memories = None
+        # the collect/update times and frames of the last train call
+        self.timings = None
         self.num_tasks = num_tasks
         self.dfas = xdfas
         self.one_off_reward = one_off_reward
@@ -45,11 +79,31 @@ class MTARL:
         self.gamma = gamma
         self.seed = seed
         self.opt = tf.keras.optimizers.Adam(learning_rate=self.lr)
+        # Mixed precision, "mixed_float16" or "mixed_bfloat16". The global Keras policy is not changed, the
+        # models are constructed with the same policy by the caller (policy= of the nets), the heads stay float32.
+        # float16 gradients can underflow, so the loss is scaled with a dynamic loss scale
+        if mixed_precision not in MIXED_PRECISION_DTYPES:
+            raise ValueError(f"mixed_precision must be one of {list(MIXED_PRECISION_DTYPES)}, got {mixed_precision!r}")
+        self.mixed_precision = mixed_precision
+        # the policy of the models is checked on their first call, see check_models_policy
+        self.models_policy_checked = False
+        self.loss_scaling = mixed_precision == "mixed_float16"
+        if self.loss_scaling:
+            self.opt = tf.keras.mixed_precision.LossScaleOptimizer(self.opt)
         self.huber = tf.keras.losses.Huber(reduction=tf.keras.losses.Reduction.NONE)
         self.num_frames_per_proc = num_frames_per_proc
         self.num_procs = num_procs
         assert self.recurrent or self.recurrence == 1
         assert num_frames_per_proc % recurrence == 0
+        # Optionally compile the per frame policy step, the loss and gradient computation, and the
+        # returns/advantage computations with XLA. These graphs are made of many small dense layers
+        # and elementwise ops on tiny tensors, fusing them removes most of the per op launch overhead
+        self.jit_compile = jit_compile
+        if jit_compile:
+            self.act = tf.function(self.act, jit_compile=True)
+            self.compute_gradients = tf.function(self.compute_gradients, jit_compile=True)
+            self.get_expected_return = tf.function(self.get_expected_return, jit_compile=True)
+            self.compute_advantages = tf.function(self.compute_advantages, jit_compile=True)
 
     def render_reset(self):
         if self.seed:
@@ -57,33 +111,78 @@ class MTARL:
         state = self.renv.reset()
         # reset the product DFA
         [d.reset() for d in self.dfas[0]]
-        # initial_state = np.append(state, np.array(self.dfas.progress, dtype=np.float32))
-        initial_state = np.array([np.append(state[k], self.dfas[0][k].progress) for k in range(self.num_agents)], dtype=np.float32)
-        return initial_state
+        # copied, numpy_function outputs may share memory with the returned array
+        return self.render_obs.assemble(state, self.dfas[0]).copy()
 
     def tf_render_reset(self):
-        return tf.numpy_function(self.render_reset, [], [tf.float32])
+        return tf.numpy_function(self.render_reset, [], [self.obs_dtype])
 
-    def call_models(self, state: tf.Tensor, *args):
+    def call_models(self, state: tf.Tensor, *args, memories: tf.Tensor = None):
+        """
+        :param state: model inputs of shape (agents, samples, 1, features)
+        :param args: either one model per agent or a single MultiAgentModel which
+            evaluates all of the agents in one forward pass
+        :param memories: recurrent models only, the LSTM memories of shape (agents, samples, memory_size).
+            If given the updated memories are returned as a third output
+        """
+        if not self.models_policy_checked:
+            self.check_models_policy(*args)
+        if len(args) == 1 and isinstance(args[0], MultiAgentModel):
+            if memories is not None:
+                raise ValueError(f"{type(args[0]).__name__} does not carry LSTM memories, it cannot be used "
+                                 f"with recurrence > 1")
+            return args[0](state)
         actions_logits_x_agents = tf.TensorArray(dtype=tf.float32, size=self.num_agents)
         values_x_agents = tf.TensorArray(dtype=tf.float32, size=self.num_agents)
+        memories_x_agents = tf.TensorArray(dtype=tf.float32, size=self.num_agents)
         ix = tf.constant(0, dtype=tf.int32)
         for model in args:
-            actions_logits, values = model(state[ix])
+            if memories is None:
+                actions_logits, values = model(state[ix])
+            else:
+                actions_logits, values, memory = model(state[ix], memory=memories[ix])
+                memories_x_agents = memories_x_agents.write(ix, memory)
             actions_logits_x_agents = actions_logits_x_agents.write(ix, actions_logits)
             values_x_agents = values_x_agents.write(ix, values)
             ix += tf.constant(1, dtype=tf.int32)
         actions_logits_x_agents = actions_logits_x_agents.stack()
         values_x_agents = values_x_agents.stack()
+        if memories is not None:
+            return actions_logits_x_agents, values_x_agents, memories_x_agents.stack()
         return actions_logits_x_agents, values_x_agents
 
+    def check_models_policy(self, *args):
+        """
+        Raises a ValueError if the hidden layers of a model do not compute in the dtype of the mixed_precision
+        option, e.g. float32 models would silently train in float32, and float16 models without
+        mixed_precision="mixed_float16" would train without loss scaling
+        """
+        expected = {MIXED_PRECISION_DTYPES[self.mixed_precision]} - {"float32"}
+        for model in args:
+            dtypes = low_precision_dtypes(model)
+            if dtypes != expected:
+                raise ValueError(f"{model.name} computes its hidden layers in {', '.join(sorted(dtypes)) or 'float32'}"
+                                 f" but MTARL(mixed_precision={self.mixed_precision!r}) expects "
+                                 f"{', '.join(expected) or 'float32'}, construct the models with "
+                                 f"policy={self.mixed_precision!r}")
+        self.models_policy_checked = True
+
+    def initial_memories(self, num_samples, *args):
+        """Zero LSTM memories, shape (agents, samples, memory_size)"""
+        if len(args) == 1 and isinstance(args[0], MultiAgentModel):
+            raise ValueError(f"{type(args[0]).__name__} does not carry LSTM memories, it cannot be used "
+                             f"with recurrence > 1")
+        if not getattr(args[0], 'memory_size', 0):
+            raise ValueError("recurrence > 1 requires recurrent models which carry an LSTM memory")
+        return tf.zeros([self.num_agents, num_samples, args[0].memory_size], dtype=tf.float32)
+
     def reset(self):
         states = []
         states.append(self.envs.reset())
-        return np.array(states, dtype=np.float32)
+        return np.array(states, dtype=self.obs_dtype.as_numpy_dtype)
 
     def tf_reset2(self):
-        return tf.numpy_function(self.reset, [], [tf.float32])
+        return tf.numpy_function(self.reset, [], [self.obs_dtype])
 
     def render_env_step(self, action: np.array) -> Tuple[np.ndarray, np.ndarray]:
         """Returns state, reward, done flag given an action"""
@@ -99,32 +198,35 @@ class MTARL:
             # agent_reward = reward
             done = False
         #rewards_ = np.array([agent_reward] + task_rewards)
-        state_ = np.array([np.append(state[k], self.dfas[0][k].progress) for k in range(self.num_agents)])
-        state_ = np.expand_dims(state_, 1)
+        state_ = np.expand_dims(self.render_obs.assemble(state, self.dfas[0]), 1)
         return (
-            state_.astype(np.float32),
+            state_.astype(self.obs_dtype.as_numpy_dtype),
             np.array(done, np.int32))
 
     def tf_render_env_step(self, action: tf.Tensor) -> List[tf.Tensor]:
-        return tf.numpy_function(self.render_env_step, [action], [tf.float32, tf.int32])
+        return tf.numpy_function(self.render_env_step, [action], [self.obs_dtype, tf.int32])
 
     def env_step(self, actions: np.array):
         actions = actions.transpose()
         state, reward, done = self.envs.step(actions)
         state = state.transpose(1, 0, 2)
         state = np.expand_dims(state, 2)
-        return state.astype(np.float32), reward.astype(np.float32), done.astype(np.int32)
+        return state.astype(self.obs_dtype.as_numpy_dtype), reward.astype(np.float32), done.astype(np.int32)
 
     def tf_env_step(self, actions: tf.Tensor) -> List[tf.Tensor]:
-        return tf.numpy_function(self.env_step, [actions], [tf.float32, tf.float32, tf.int32])
+        return tf.numpy_function(self.env_step, [actions], [self.obs_dtype, tf.float32, tf.int32])
 
     def render_episode(self, initial_state: tf.Tensor, max_steps: tf.int32, *args):
         state = initial_state
+        memories = self.initial_memories(1, *args) if self.recurrent else None
         # initial_state_shape = initial_state.shape
         for _ in tf.range(max_steps):
             self.renv.render('human')
             # Run the model to get an action probability distribution
-            action_logits_t, _ = self.call_models(state, *args)
+            if self.recurrent:
+                action_logits_t, _, memories = self.call_models(state, *args, memories=memories)
+            else:
+                action_logits_t, _ = self.call_models(state, *args)
             action_logits_t = tf.squeeze(action_logits_t, axis=1)
             actions = self.collect_actions(action_logits_t)
             # Apply the action to the environment to get the next state and reward
@@ -133,18 +235,57 @@ class MTARL:
             if tf.cast(done, tf.bool):
                 break
 
+    def record_episode(self, recorder: EpisodeRecorder, name: str, max_steps: int, *args) -> bool:
+        """
+        Off-screen alternative to render_episode, an episode of the render env (env_key) is recorded by a
+        background process from a snapshot of the models and written to {recorder.directory}/{name}.npz
+        :return: whether the recording was started, it is skipped while the previous one is running
+        """
+        if self.recurrent:
+            raise ValueError(f"Episodes can only be recorded for non-recurrent models, "
+                             f"got recurrence={self.recurrence}")
+        # the rollout buffers are only allocated by the first reset, size the inputs from the render env
+        # observation space and the number of tasks (the xDFA progress) instead
+        space = self.renv.observation_space
+        if isinstance(space, gym.spaces.Dict):
+            space = space['image']
+        num_features = int(np.prod(space.shape)) + len(self.dfas[0][0].dfas)
+        if len(args) == 1 and isinstance(args[0], MultiAgentModel):
+            input_shape = (self.num_agents, 1, 1, num_features)
+        else:
+            input_shape = (1, 1, num_features)
+        return recorder.record(team_episode, self.renv, self.dfas[0], args, input_shape, name, max_steps)
+
+    def sample_actions(self, action_logits: tf.Tensor) -> Tuple[tf.Tensor, tf.Tensor, tf.Tensor]:
+        """
+        Samples the actions of all agents and samples in one op
+        :param action_logits: actions logits is a tensor of shape (agents, samples, env_action_space)
+        :return: actions, log probabilities of the actions and policy entropy, each of shape (agents, samples)
+        """
+        return sample_actions(action_logits, gumbel=self.gumbel_sampling)
+
     def collect_actions(self, action_logits: tf.Tensor) -> tf.Tensor:
         """
         :param action_logits: actions logits is a tensor of shape (agents, samples, env_action_space)
         """
-        actions = tf.TensorArray(dtype=tf.int32, size=self.num_agents)
-        for idx in tf.range(self.num_agents):
-            action_set = tf.random.categorical(action_logits[idx, :, :], num_samples=1, dtype=tf.int32)
-            action_set = tf.squeeze(action_set)
-            actions = actions.write(idx, action_set)
-        actions = actions.stack()
+        actions, _, _ = self.sample_actions(action_logits)
         return actions
 
+    def act(self, state: tf.Tensor, *args, memories: tf.Tensor = None):
+        """
+        A single rollout frame for all agents and samples: runs the models and samples the actions
+        :param state: model inputs of shape (agents, samples, 1, features)
+        :return: actions (A, S), action log probs (A, S), values (A, S, 1, tasks + 1) and, for recurrent
+            models, the updated memories
+        """
+        if memories is None:
+            action_logits, values = self.call_models(state, *args)
+        else:
+            action_logits, values, memories = self.call_models(state, *args, memories=memories)
+        # action_logits [agents, samples, 1, actions] -> [agents, samples, actions]
+        actions, log_probs, _ = self.sample_actions(tf.squeeze(action_logits, axis=2))
+        return actions, log_probs, values, memories
+
     #@tf.function
     def collect_batch(self, initial_obs: tf.Tensor, log_reward: tf.Tensor, *args):
         """Collects rollouts and computes advantages
@@ -155,40 +296,52 @@ class MTARL:
         Expected shapes:
         T - timesteps, A - agents, S - samples, F - features
         actions - (T, A, S)
+        log probs - (T, A, S)
         observations - (T, S, A, F)
         values - (T, A, S, tasks + 1)
         rewards - (T, S, A, tasks + 1)
         mask - (T, S)
+        memories - (T, A, S, memory_size), the LSTM memory before each frame, None if not recurrent
         initial state - (S, A, F)
         log rewards - (S, A, tasks + 1)
         In this way we keep the model inputs for a batch discrete.
+        For recurrent models the LSTM memories are carried across batches in self.memories
+        and are reset for the environments which finish an episode.
         """
         #print("initial state shape ", initial_obs.shape)
         #print("log reward shape ", log_reward.shape)
-        observations = tf.TensorArray(dtype=tf.float32, size=self.num_frames_per_proc)
+        observations = tf.TensorArray(dtype=self.obs_dtype, size=self.num_frames_per_proc)
         selected_actions = tf.TensorArray(dtype=tf.int32, size=self.num_frames_per_proc)
+        action_log_probs = tf.TensorArray(dtype=tf.float32, size=self.num_frames_per_proc)
         values = tf.TensorArray(dtype=tf.float32, size=0, dynamic_size=True)
         rewards = tf.TensorArray(dtype=tf.float32, size=self.num_frames_per_proc)
         masks = tf.TensorArray(dtype=tf.float32, size=self.num_frames_per_proc)
         running_rewards = tf.TensorArray(dtype=tf.float32, size=0, dynamic_size=True)
+        memories = tf.TensorArray(dtype=tf.float32, size=self.num_frames_per_proc)
+        if self.recurrent and self.memories is None:
+            self.memories = self.initial_memories(self.num_procs, *args)
+        memory = self.memories
         log_reward_shape = log_reward.shape
         state = initial_obs
         state_shape = initial_obs.shape
         log_reward_counter = tf.constant(0, dtype=tf.int32)
         for i in tf.range(self.num_frames_per_proc):
             observations = observations.write(i, state)
-            action_logits_t_x_agents, value_x_agents = self.call_models(state, *args)
+            if self.recurrent:
+                memories = memories.write(i, memory)
+            actions, log_probs, value_x_agents, memory = self.act(state, *args, memories=memory)
             # value = self.critic(state)
             values = values.write(i, value_x_agents)
-            # action_logits [samples, 1, actions] -> [samples, actions]
-            action_logits_t_x_agents = tf.squeeze(action_logits_t_x_agents)
-            # actions = tf.random.categorical(action_logits_t, num_samples=1, dtype=tf.int32)
-            actions = self.collect_actions(action_logits_t_x_agents)
             selected_actions = selected_actions.write(i, actions)
+            # the behaviour policy log probabilities are kept for the PPO ratio
+            action_log_probs = action_log_probs.write(i, log_probs)
             state, reward_, done_ = self.tf_env_step(actions)
             state.set_shape(state_shape)
             mask = tf.constant(1.0, dtype=tf.float32) - tf.cast(done_, dtype=tf.float32)
             masks = masks.write(i, mask)
+            if self.recurrent:
+                # start the next episode from a zero memory
+                memory = memory * tf.reshape(mask, [1, -1, 1])
             # print(f"mask shape: {mask.shape}, state shape: {state.shape}, log reward shape: {log_reward.shape}, reward shape: {reward_.shape}")
             reward_ = tf.transpose(reward_, perm=[1, 0, 2])
             log_reward += reward_
@@ -207,17 +360,27 @@ class MTARL:
         ##   D - tasks + 1  (agent)
         # action_probs = action_probs.stack() #
         if self.shaped_rewards:
-            _, value = self.call_models(state, *args)
+            if self.recurrent:
+                _, value, _ = self.call_models(state, *args, memories=memory)
+            else:
+                _, value = self.call_models(state, *args)
             values = values.write(self.num_frames_per_proc, value)
+        if self.recurrent:
+            self.memories = memory
+            memories = memories.stack()
+        else:
+            memories = None
         values = values.stack()
         rewards = rewards.stack()
         masks = masks.stack()
         selected_actions = selected_actions.stack()
+        action_log_probs = action_log_probs.stack()
         observations = observations.stack()
         running_rewards = running_rewards.stack()
         # observations = tf.squeeze(observations)
         values = tf.squeeze(values)
-        return selected_actions, observations, values, rewards, masks, state, running_rewards, log_reward
+        return selected_actions, observations, values, rewards, masks, state, running_rewards, log_reward, \
+            action_log_probs, memories
 
     def tf_2d_indices(self, agent: tf.int32, size: tf.int32, indices=tf.Tensor):
         x = tf.repeat(agent, size)
@@ -268,6 +431,39 @@ class MTARL:
         returns = returns.stack()[::-1]
         return returns
 
+    def get_vtrace_returns(self, rewards: tf.Tensor, values: tf.Tensor, bootstrap_value: tf.Tensor,
+                           masks: tf.Tensor, log_rhos: tf.Tensor) -> Tuple[tf.Tensor, tf.Tensor]:
+        """
+        V-trace targets for each of the tasks + 1 value heads, correcting for the lag between the
+        behaviour policy which collected the batch and the target (learner) policy.
+        Expected shapes:
+        rewards, values - (T, A, S, tasks + 1)
+        bootstrap value - (A, S, tasks + 1)
+        masks - (T, S)
+        log rhos - (T, A, S), log target policy prob - log behaviour policy prob
+        :return: value targets vs and the policy gradient returns r_t + gamma * vs_{t+1}, both (T, A, S, tasks + 1)
+        """
+        n = tf.shape(rewards)[0]
+        rhos = tf.math.exp(log_rhos)
+        clipped_rhos = tf.expand_dims(tf.math.minimum(self.vtrace_rho_bar, rhos), 3)
+        cs = tf.expand_dims(tf.math.minimum(self.vtrace_c_bar, rhos), 3)
+        # the episode ends at t when the mask is 0, there is then no next state value
+        discounts = self.gamma * tf.reshape(masks, [-1, 1, self.num_procs, 1])
+        next_values = tf.concat([values[1:], tf.expand_dims(bootstrap_value, 0)], axis=0)
+        deltas = clipped_rhos * (rewards + discounts * next_values - values)
+        # Accumulate vs - V backwards in time
+        vs_minus_v = tf.TensorArray(dtype=tf.float32, size=n)
+        acc = tf.zeros_like(bootstrap_value)
+        acc_shape = acc.shape
+        for i in tf.range(n - 1, -1, -1):
+            acc = deltas[i] + discounts[i] * cs[i] * acc
+            acc.set_shape(acc_shape)
+            vs_minus_v = vs_minus_v.write(i, acc)
+        vs = values + vs_minus_v.stack()
+        next_vs = tf.concat([vs[1:], tf.expand_dims(bootstrap_value, 0)], axis=0)
+        pg_returns = rewards + discounts * next_vs
+        return vs, pg_returns
+
     def df(self, x: tf.Tensor) -> tf.Tensor:
         """derivative mean squared error"""
         if tf.less_equal(x, self.c):
@@ -279,7 +475,8 @@ class MTARL:
         if tf.less_equal(x, self.e):
             return 2 * (x - self.e)
         else:
-            return tf.convert_to_tensor([0.0])
+            # scalar, as in the other branch, so that both branches of the conditional have the same shape
+            return tf.convert_to_tensor(0.0)
 
     def computeH_proc_i(self, X: tf.Tensor, Xi: tf.Tensor, proc: tf.int32, agent: tf.int32, mu: tf.Tensor) -> tf.Tensor:
         # should be a relatively small calculation
@@ -327,60 +524,81 @@ class MTARL:
             loss += tf.reduce_mean(alloc_proc_loss_task_j)
         return loss
 
+    def evaluate_sub_batch(self, observations: tf.Tensor, masks: tf.Tensor, ix: tf.Tensor, *args,
+                           ppo=False, memory: tf.Tensor = None):
+        """
+        Evaluates the models on the sub batch of frames ix of all agents
+        :param ppo: the observations are not masked, so that the action log probs are those of the states the
+            behaviour log probs were recorded on, see update_loss
+        :return: action logits (A, B, actions), values (A, B, tasks + 1), the sub batch mask (B, 1) and the
+            updated memory (recurrent models, otherwise None)
+        """
+        # observations: (A, B, 1, F)
+        sb_obss_x_agents = tf.gather(observations, indices=ix, axis=1)
+        # Construct the sub batch mask from experiences
+        mask = tf.expand_dims(tf.gather(masks, indices=ix), 1)
+        if self.recurrent:
+            actions_logits_x_agents, values_x_agents, memory = \
+                self.call_models(sb_obss_x_agents, *args, memories=memory)
+            memory = memory * tf.reshape(mask, [1, -1, 1])
+        elif ppo:
+            actions_logits_x_agents, values_x_agents = self.call_models(sb_obss_x_agents, *args)
+        else:
+            masked_inputs = sb_obss_x_agents * tf.cast(tf.reshape(mask, [1, -1, 1, 1]), sb_obss_x_agents.dtype)
+            actions_logits_x_agents, values_x_agents = self.call_models(masked_inputs, *args)
+        return tf.squeeze(actions_logits_x_agents, axis=2), tf.squeeze(values_x_agents, axis=2), mask, memory
+
     #@tf.function
     def update_loss(self,
                     observations: tf.Tensor,
                     actions: tf.Tensor,
                     masks: tf.Tensor, returns: tf.Tensor,
                     advantages: tf.Tensor,
-                    ii: tf.Tensor, *args):
+                    ii: tf.Tensor, *args,
+                    old_log_probs: tf.Tensor = None,
+                    memories: tf.Tensor = None):
+        """
+        Computes the actor-critic loss of each agent over the sub batch starting at the indices ii
+        :param old_log_probs: the behaviour log probabilities of the actions, shape (A, S * T). If given
+            the actor loss is the PPO clipped surrogate rather than the A2C policy gradient loss. The
+            behaviour log probs were computed on the unmasked observations, so the models are evaluated on
+            those and the mask is applied to the per sample loss terms instead, the ratio is then 1 before
+            the first update
+        :param memories: recurrent models only, the LSTM memories stored during the rollout, shape
+            (A, S * T, memory_size). The memory stored at each chunk start ii is unrolled over the
+            following recurrence frames (truncated BPTT), being reset at episode boundaries
+        """
+        ppo = old_log_probs is not None
         loss = tf.constant([0.0] * self.num_agents, dtype=tf.float32)
-        for t in tf.range(self.recurrence):
+        memory = tf.gather(memories, indices=ii, axis=1) if self.recurrent else None
+        # a python loop, the recurrence is small and the unrolled steps trace into one graph
+        for t in range(self.recurrence):
             ix = ii + t
             # Construct a sub batch of experiences for the timestep t across all of the samples
-            sb_obss_x_agents = tf.TensorArray(dtype=tf.float32, size=self.num_agents)
-            sb_advs_x_agents = tf.TensorArray(dtype=tf.float32, size=self.num_agents)
-            sb_rets_x_agents = tf.TensorArray(dtype=tf.float32, size=self.num_agents)
-            # compute the sub batch values for each of the agents
-            for agent in tf.range(self.num_agents):
-                iz = self.tf_2d_indices(agent, ii.shape[0], indices=ix)
-                sb_obss_x_agents = sb_obss_x_agents.write(agent, tf.gather_nd(observations, indices=iz))
-                sb_advs_x_agents = sb_advs_x_agents.write(agent, tf.gather_nd(advantages, indices=iz))
-                sb_rets_x_agents = sb_rets_x_agents.write(agent, tf.gather_nd(returns, indices=iz))
-            sb_obss_x_agents = sb_obss_x_agents.stack()
-            sb_advs_x_agents = sb_advs_x_agents.stack()
-            sb_rets_x_agents = sb_rets_x_agents.stack()
-            # Construct the sub batch mask from experiences
-            mask = tf.expand_dims(tf.gather(masks, indices=ix), 1)
+            # and agents, advantages: (A, B), returns: (A, B, tasks + 1)
+            sb_advs_x_agents = tf.gather(advantages, indices=ix, axis=1)
+            sb_rets_x_agents = tf.gather(returns, indices=ix, axis=1)
+            sb_acts_x_agents = tf.gather(actions, indices=ix, axis=1)
             # Compute the actor and critic loss value for the respective agents
-            actions_logits_x_agents, values_x_agents = [], []
-            agent = tf.constant(0)
-            for model in args:
-                masked_inputs = tf.expand_dims(tf.squeeze(sb_obss_x_agents[agent]) * mask, 1)
-                action_logits, values = model.call(masked_inputs)
-                actions_logits_x_agents.append(action_logits)
-                values_x_agents.append(values)
-                agent += tf.constant(1)
-            value = tf.squeeze(values_x_agents)
-            action_logits_t = tf.squeeze(actions_logits_x_agents)
+            action_logits_t, value, mask, memory = \
+                self.evaluate_sub_batch(observations, masks, ix, *args, ppo=ppo, memory=memory)
             critic_loss = self.huber(value, sb_rets_x_agents)
-            loss_update = tf.TensorArray(dtype=tf.float32, size=self.num_agents)
-            for agent in tf.range(self.num_agents):
-                iz = self.tf_2d_indices(agent, ii.shape[0], indices=ix)
-                actions_selected = tf.gather_nd(actions, indices=iz)
-                action_probs_t = tf.nn.softmax(action_logits_t[agent])
-                #entropy = self.entropy_coef * tf.reduce_mean(tfp.distributions.Categorical(logits=action_logits_t[agent]).entropy())
-                #tf.print("entropy shape ", entropy)
-                x = tf.range(ii.shape[0])
-                y = tf.transpose([x, actions_selected])
-                action_probs = tf.gather_nd(action_probs_t, indices=y)
-                actor_loss_agent = tf.math.reduce_mean(tf.math.log(action_probs) * sb_advs_x_agents[agent])
-                # entropy_raw = tf.nn.softmax_cross_entropy_with_logits(action_probs_t, action_logits_t[agent])
-                # entropy = self.entropy_coef * tf.reduce_mean(entropy_raw)
-                critic_loss_agent = tf.nn.compute_average_loss(critic_loss[agent])
-                #tf.print("entropy ", entropy, "agent_loss ", actor_loss_agent)
-                loss_update = loss_update.write(agent, actor_loss_agent + critic_loss_agent) #
-            loss_update = loss_update.stack()
+            # log probabilities and entropy of all agents in one op
+            action_log_probs, entropy = log_probs_entropy(action_logits_t, sb_acts_x_agents)
+            if not ppo:
+                actor_loss = action_log_probs * sb_advs_x_agents
+            else:
+                # The A2C actor loss minimises log_prob * advantage, so the clipped surrogate
+                # is taken with respect to the negated advantage: max(r * A, clip(r) * A)
+                ratio = tf.math.exp(action_log_probs - tf.gather(old_log_probs, indices=ix, axis=1))
+                clipped_ratio = tf.clip_by_value(ratio, 1.0 - self.clip_eps, 1.0 + self.clip_eps)
+                actor_loss = tf.math.maximum(ratio * sb_advs_x_agents, clipped_ratio * sb_advs_x_agents)
+                if not self.recurrent:
+                    loss_mask = tf.reshape(mask, [1, -1])
+                    actor_loss, critic_loss, entropy = \
+                        actor_loss * loss_mask, critic_loss * loss_mask, entropy * loss_mask
+            loss_update = tf.math.reduce_mean(actor_loss, axis=1) + tf.math.reduce_mean(critic_loss, axis=1) - \
+                self.entropy_coef * tf.math.reduce_mean(entropy, axis=1)
             loss += loss_update
         loss /= self.recurrence
         return loss
@@ -391,7 +609,7 @@ class MTARL:
         # We require values and returns for huber loss
         # We require advantages for actor loss
         # collect the batch of experiences for all environments over the range of time-steps
-        acts, obss, values, rewards, masks, state, running_rewards, log_reward = \
+        acts, obss, values, rewards, masks, state, running_rewards, log_reward, log_probs, memories = \
             self.collect_batch(initial_state, log_reward, *args)
 
         # if we are using shaped rewards we don't use the returns and the values shape will be one datum larger than usual
@@ -405,6 +623,12 @@ class MTARL:
         masks = tf.reshape(tf.transpose(masks), [-1])
         acts = tf.transpose(acts, perm=[1, 2, 0])
         acts = tf.reshape(acts, [self.num_agents, self.num_frames_per_proc * self.num_procs])
+        log_probs = tf.transpose(log_probs, perm=[1, 2, 0])
+        log_probs = tf.reshape(log_probs, [self.num_agents, self.num_frames_per_proc * self.num_procs])
+        if self.recurrent:
+            # memories: T x A x S x M -> A x S x T x M -> A x (S * T) x M
+            memories = tf.transpose(memories, perm=[1, 2, 0, 3])
+            memories = tf.reshape(memories, [self.num_agents, self.num_frames_per_proc * self.num_procs, -1])
         # # Concatenate the samples together =>
         returns = tf.transpose(returns, perm=[2, 1, 0, 3])
         obss = tf.transpose(obss, perm=[1, 2, 0, 3, 4])
@@ -425,25 +649,170 @@ class MTARL:
         returns = tf.convert_to_tensor(returns)
         observations = tf.convert_to_tensor(observations)
         acts = tf.convert_to_tensor(acts)
+        log_probs = tf.convert_to_tensor(log_probs)
         return observations, acts, masks, returns, values, advantages, state, \
-               log_reward, running_rewards, ini_values
+               log_reward, running_rewards, ini_values, log_probs, memories
+
+    def compute_gradients(self, observations, acts, masks, returns, advantages, ii, *models,
+                          old_log_probs=None, memories=None):
+        """Computes the loss of each agent and the gradients of the loss with respect to the model variables"""
+        with tf.GradientTape() as tape:
+            loss = self.update_loss(observations, acts, masks, returns, advantages, ii, *models,
+                                    old_log_probs=old_log_probs, memories=memories)
+            scaled_loss = self.scale_loss(loss)
+        vars_l = [m.trainable_variables for m in models]
+        grads_l = self.unscale_gradients(tape.gradient(scaled_loss, vars_l))
+        return loss, grads_l
+
+    def scale_loss(self, loss):
+        """Scales the loss of mixed float16 training by the dynamic loss scale"""
+        if not self.loss_scaling:
+            return loss
+        # the tf_keras (Keras 2) and Keras 3 loss scale optimizers name the method differently
+        if hasattr(self.opt, "get_scaled_loss"):
+            return self.opt.get_scaled_loss(loss)
+        return self.opt.scale_loss(loss)
+
+    def unscale_gradients(self, grads_l):
+        """
+        Undoes the loss scaling of mixed float16 training. The tf_keras loss scale optimizer applies unscaled
+        gradients. The Keras 3 optimizer divides the gradients by its loss scale in apply_gradients, where it
+        also skips the update and lowers the scale if they overflowed, so they are returned still scaled
+        """
+        if not self.loss_scaling or not hasattr(self.opt, "get_unscaled_gradients"):
+            return grads_l
+        return [self.opt.get_unscaled_gradients(grads) for grads in grads_l]
+
+    def apply_gradients(self, grads_l, *models):
+        vars_l = [m.trainable_variables for m in models]
+        grads_l_ = [x for y in grads_l for x in y]
+        vars_l_ = [x for y in vars_l for x in y]
+        self.opt.apply_gradients(zip(grads_l_, vars_l_))
+
+    def ppo_update(self, observations, acts, masks, returns, advantages, old_log_probs, ii, *models, memories=None):
+        """
+        Several epochs of clipped surrogate updates over shuffled minibatches of the collected rollouts
+        :param ii: starting indices of the sub batches, these are shuffled and split into minibatches
+        :return: the mean loss of each agent over all of the minibatch updates
+        """
+        num_indices = ii.shape[0]
+        minibatch_size = int(np.ceil(num_indices / self.num_minibatches))
+        losses = []
+        for _ in range(self.ppo_epochs):
+            shuffled_ii = tf.random.shuffle(ii)
+            for start in range(0, num_indices, minibatch_size):
+                mb_ii = shuffled_ii[start:start + minibatch_size]
+                loss, grads_l = self.compute_gradients(
+                    observations, acts, masks, returns, advantages, mb_ii, *models,
+                    old_log_probs=old_log_probs, memories=memories)
+                self.apply_gradients(grads_l, *models)
+                losses.append(loss)
+        return tf.reduce_mean(tf.stack(losses), axis=0)
 
     #@tf.function
-    def train(self, initial_state: tf.Tensor, log_reward: tf.Tensor, ii: tf.Tensor, mu: tf.Tensor, *models):
+    def train(self, initial_state: tf.Tensor, log_reward: tf.Tensor, ii: tf.Tensor, mu: tf.Tensor, *models,
+              accumulate_steps=1):
         """
         :param initial_state: The initial states across the sample environments, shape: (samples x features)
         :param log_reward: A logging helper tensor which captures the current rewards
             across samples per episode, shape: (timesteps, samples, agents, (tasks + 1))
         :param ii: starting indices used in recurrent calculations
+        :param accumulate_steps: the number of collect/update cycles whose gradients are averaged
+            before a single optimiser step. The effective batch is accumulate_steps * num_procs *
+            num_frames_per_proc frames while only one cycle of rollout tensors is alive at a time
+        If the agent was constructed with ppo=True the collected batch is reused for ppo_epochs
+        epochs of num_minibatches clipped surrogate updates, otherwise a single A2C update is made.
         """
-
-        observations, acts, masks, returns, values, advantages, state, log_reward, \
-            running_rewards, ini_values = self.train_preprocess(initial_state, log_reward, ii, mu, *models)
+        if self.ppo and accumulate_steps > 1:
+            raise ValueError("Gradient accumulation is not supported with PPO updates")
+        accumulated_grads = None
+        losses, running_rewards_l = [], []
+        collect_time, update_time = 0.0, 0.0
+        state = initial_state
+        for _ in range(accumulate_steps):
+            start = time.perf_counter()
+            observations, acts, masks, returns, values, advantages, state, log_reward, \
+                running_rewards, ini_values, log_probs, memories = \
+                self.train_preprocess(state, log_reward, ii, mu, *models)
+            collect_time += time.perf_counter() - start
+            start = time.perf_counter()
+            running_rewards_l.append(running_rewards)
+            if self.ppo:
+                loss = self.ppo_update(observations, acts, masks, returns, advantages, log_probs, ii, *models,
+                                       memories=memories)
+            else:
+                loss, grads_l = self.compute_gradients(observations, acts, masks, returns, advantages, ii, *models,
+                                                       memories=memories)
+                accumulated_grads = self.accumulate_gradients(accumulated_grads, grads_l)
+            losses.append(loss)
+            update_time += time.perf_counter() - start
+        start = time.perf_counter()
+        if not self.ppo:
+            if accumulate_steps > 1:
+                accumulated_grads = [[None if g is None else g / accumulate_steps for g in grads]
+                                     for grads in accumulated_grads]
+            self.apply_gradients(accumulated_grads, *models)
+        # wall clock times (seconds) and frames of the last call, see RunLogger
+        self.timings = {'collect': collect_time, 'update': update_time + time.perf_counter() - start,
+                        'frames': accumulate_steps * self.num_procs * self.num_frames_per_proc}
+        loss = losses[0] if accumulate_steps == 1 else tf.reduce_mean(tf.stack(losses), axis=0)
+        # episodes may not finish in every cycle, in which case the running rewards are empty
+        finished = [r for r in running_rewards_l if r.shape[0]]
+        running_rewards = tf.concat(finished, axis=0) if finished else running_rewards_l[-1]
+        return state, log_reward, running_rewards, loss, ini_values
+
+    @staticmethod
+    def accumulate_gradients(accumulated_grads, grads_l):
+        """Sums per model gradient lists, variables without a gradient stay None"""
+        if accumulated_grads is None:
+            return grads_l
+        return [[g if a is None else (a if g is None else a + g) for a, g in zip(acc, grads)]
+                for acc, grads in zip(accumulated_grads, grads_l)]
+
+    def train_vtrace(self, trajectory, mu: tf.Tensor, *models):
+        """
+        A learner update from a trajectory collected by a (possibly stale) copy of the models,
+        see a2c_team_tf/lib/actor_learner.py. The target policy is re-evaluated on the trajectory and
+        the lag between the behaviour and target policy is corrected with V-trace.
+        :param trajectory: the tuple returned by collect_batch
+        :return: loss, ini_values
+        """
+        if self.shaped_rewards or self.recurrent:
+            raise ValueError(f"V-trace updates are not supported with shaped_rewards={self.shaped_rewards} or "
+                             f"recurrence={self.recurrence}")
+        acts, obss, _, rewards, masks, state, _, _, behaviour_log_probs, _ = trajectory
+        # Evaluate all of the frames at once: T x A x S x 1 x F -> A x (T * S) x 1 x F
+        obs_shape = tf.shape(obss)
+        observations = tf.reshape(tf.transpose(obss, perm=[1, 0, 2, 3, 4]),
+                                  [self.num_agents, -1, 1, obs_shape[-1]])
         with tf.GradientTape() as tape:
-            loss = self.update_loss(observations, acts, masks, returns, advantages, ii, *models)
+            action_logits, values = self.call_models(observations, *models)
+            # A x (T * S) x 1 x D -> T x A x S x D
+            action_logits = tf.transpose(
+                tf.reshape(action_logits, [self.num_agents, -1, self.num_procs, tf.shape(action_logits)[-1]]),
+                perm=[1, 0, 2, 3])
+            values = tf.transpose(
+                tf.reshape(values, [self.num_agents, -1, self.num_procs, self.num_tasks + 1]),
+                perm=[1, 0, 2, 3])
+            _, bootstrap_value = self.call_models(state, *models)
+            bootstrap_value = tf.stop_gradient(tf.squeeze(bootstrap_value, axis=2))
+            log_probs, entropy = log_probs_entropy(action_logits, acts)
+            log_rhos = tf.stop_gradient(log_probs) - behaviour_log_probs
+            vs, pg_returns = self.get_vtrace_returns(
+                rewards, tf.stop_gradient(values), bootstrap_value, masks, log_rhos)
+            ini_values = tf.stop_gradient(values[0])
+            # advantages: A x S x T x 1 -> A x T x S
+            advantages = self.compute_advantages(pg_returns, tf.stop_gradient(values), ini_values, mu)
+            advantages = tf.transpose(tf.squeeze(advantages, axis=3), perm=[0, 2, 1])
+            clipped_rhos = tf.math.minimum(self.vtrace_rho_bar, tf.math.exp(log_rhos))
+            advantages = tf.transpose(clipped_rhos, perm=[1, 0, 2]) * advantages
+            actor_loss = tf.math.reduce_mean(tf.transpose(log_probs, perm=[1, 0, 2]) * advantages, axis=[1, 2])
+            critic_loss = tf.math.reduce_mean(
+                tf.transpose(self.huber(values, tf.stop_gradient(vs)), perm=[1, 0, 2]), axis=[1, 2])
+            entropy = tf.math.reduce_mean(tf.transpose(entropy, perm=[1, 0, 2]), axis=[1, 2])
+            loss = actor_loss + critic_loss - self.entropy_coef * entropy
+            scaled_loss = self.scale_loss(loss)
         vars_l = [m.trainable_variables for m in models]
-        grads_l = tape.gradient(loss, vars_l)
-        grads_l_ = [x for y in grads_l for x in y]
-        vars_l_ = [x for y in vars_l for x in y]
-        self.opt.apply_gradients(zip(grads_l_, vars_l_))
-        return state, log_reward, running_rewards, loss, ini_values
\ No newline at end of file
+        grads_l = self.unscale_gradients(tape.gradient(scaled_loss, vars_l))
+        self.apply_gradients(grads_l, *models)
+        return loss, ini_values
@@ -2,24 +2,45 @@ import tensorflow as tf
 from tensorflow.keras import layers
 from typing import Tuple, List
 
+# Mixed precision: the nets take a dtype policy, e.g. "mixed_float16" or "mixed_bfloat16", for their hidden
+# layers (None uses the global Keras policy). The actor and critic heads always compute in float32 so the
+# logits and values are float32 whatever the policy, see also the mixed_precision option of MTARL
+HEAD_DTYPE = "float32"
+
+
+def float_inputs(inputs: tf.Tensor, layer: layers.Layer) -> tf.Tensor:
+    """Casts the inputs, e.g. compact int8 observations (see obs_dtype of MTARL), to the compute dtype of the
+    first layer, the cast is a no-op for inputs which already have that dtype"""
+    return tf.cast(inputs, layer.compute_dtype)
+
+
+def low_precision_dtypes(model: tf.keras.Model) -> set:
+    """The compute dtypes other than float32 of the layers of a model, e.g. {"float16"} for a net built with
+    policy="mixed_float16" (its heads compute in float32) and an empty set for a float32 net"""
+    # _flatten_layers is private, but it is the only recursive layer walk in both tf_keras and Keras 3
+    return {layer.compute_dtype for layer in model._flatten_layers(include_self=False, recursive=True)
+            if layer.compute_dtype != "float32"}
+
 
 class ActorCritic(tf.keras.Model):
     """Actor-critic Neural Network"""
 
-    def __init__(self, n_actions: int, hidden_units: int, num_tasks: int, name: str, activation="relu"):
+    def __init__(self, n_actions: int, hidden_units: int, num_tasks: int, name: str, activation="relu",
+                 policy=None):
         """
         :param n_actions: The number of actions in a model
         :param hidden_units: The number of hidden units
+        :param policy: The dtype policy of the hidden layers
         :param name
         """
         super().__init__()
-        self.fc1 = layers.Dense(hidden_units, activation=activation)
-        self.actor = layers.Dense(n_actions)
-        self.critic = layers.Dense(num_tasks + 1)  # tasks + the agent
+        self.fc1 = layers.Dense(hidden_units, activation=activation, dtype=policy)
+        self.actor = layers.Dense(n_actions, dtype=HEAD_DTYPE)
+        self.critic = layers.Dense(num_tasks + 1, dtype=HEAD_DTYPE)  # tasks + the agent
         self.model_name = name
 
     def __call__(self, inputs: tf.Tensor) -> Tuple[tf.Tensor, tf.Tensor]:
-        x = self.fc1(inputs)
+        x = self.fc1(float_inputs(inputs, self.fc1))
         return self.actor(x), self.critic(x)
 
 
@@ -27,97 +48,356 @@ class DeepActorCritic(tf.keras.Model):
     """Actor-critic Neural Network"""
 
     def __init__(self, n_actions: int, hidden_units: int, num_tasks: int,
-                 name: str, feature_set: int, activation="relu"):
+                 name: str, feature_set: int, activation="relu", depth=1, sequence_input=False, policy=None):
         """
         :param n_actions: The number of actions in a model
         :param hidden_units: The number of hidden units
+        :param feature_set: The number of units of the feature layers, usually the input size
+        :param depth: The number of feature layers applied before the hidden layer
+        :param sequence_input: Inputs are zero padded sequences (batch, time, features), the padded
+            time steps are masked
+        :param policy: The dtype policy of the hidden layers
         :param name
         """
         super().__init__()
-        self.mask = layers.Masking()
-        self.fc1 = layers.TimeDistributed(layers.Dense(feature_set, activation=activation))
-        self.fc2 = layers.Dense(hidden_units, activation=activation)
-        self.actor = layers.Dense(n_actions)
-        self.critic = layers.Dense(num_tasks + 1)  # tasks + the agent
+        self.sequence_input = sequence_input
+        self.mask = layers.Masking() if sequence_input else None
+        self.trunk = [layers.Dense(feature_set, activation=activation, dtype=policy) for _ in range(depth)]
+        self.trunk.append(layers.Dense(hidden_units, activation=activation, dtype=policy))
+        self.actor = layers.Dense(n_actions, dtype=HEAD_DTYPE)
+        self.critic = layers.Dense(num_tasks + 1, dtype=HEAD_DTYPE)  # tasks + the agent
         self.model_name = name
 
     def call(self, inputs: tf.Tensor) -> Tuple[tf.Tensor, tf.Tensor]:
-        embedding = self.mask(inputs)
-        x = self.fc1(embedding)
-        x = self.fc1(x)
-        x = self.fc2(x)
+        x = float_inputs(inputs, self.trunk[0])
+        x = self.mask(x) if self.sequence_input else x
+        # Dense layers act on the last axis, so (samples, 1, features) inputs need no TimeDistributed wrapper
+        for layer in self.trunk:
+            x = layer(x)
         return self.actor(x), self.critic(x)
 
 
+def lstm_initial_state(memory: tf.Tensor, dtype=tf.float32):
+    """Splits a stored memory of shape (batch, 2 * units) into the LSTM (h, c) state, None starts from zeros"""
+    if memory is None:
+        return None
+    return tf.split(tf.cast(memory, dtype), 2, axis=-1)
+
+
+def check_memory(model: tf.keras.Model, memory: tf.Tensor):
+    """Only recurrent models carry a memory between frames"""
+    if memory is not None and not model.recurrent:
+        raise ValueError(f"{type(model).__name__} was built with recurrent=False, it has no LSTM memory to "
+                         f"continue from")
+
+
+def lstm_memory(h: tf.Tensor, c: tf.Tensor):
+    """The memory stored between frames, always float32"""
+    return tf.cast(tf.concat([h, c], axis=-1), tf.float32)
+
+
 class Actor(tf.keras.Model):
-    def __init__(self, num_actions, recurrent=False):
+    def __init__(self, num_actions, recurrent=False, lstm_units=64, policy=None):
         super().__init__()
         self.recurrent = recurrent
+        # the (h, c) state of the LSTM is carried between frames as a memory of shape (batch, 2 * units)
+        self.memory_size = 2 * lstm_units if recurrent else 0
         if recurrent:
-            self.lstm = tf.keras.layers.RNN(tf.keras.layers.LSTMCell(64))
-        self.fc1 = tf.keras.layers.Dense(64, activation='tanh')
-        self.fc2 = tf.keras.layers.Dense(64, activation='tanh')
+            self.lstm = tf.keras.layers.RNN(tf.keras.layers.LSTMCell(lstm_units, dtype=policy), return_state=True,
+                                            dtype=policy)
+        self.fc1 = tf.keras.layers.Dense(64, activation='tanh', dtype=policy)
+        self.fc2 = tf.keras.layers.Dense(64, activation='tanh', dtype=policy)
         # self.fc3 = tf.keras.layers.Dense(32, activation='tanh')
-        self.a = tf.keras.layers.Dense(num_actions, activation=None)
+        self.a = tf.keras.layers.Dense(num_actions, activation=None, dtype=HEAD_DTYPE)
 
-    def call(self, input, mask=None):
+    def call(self, input, mask=None, memory=None):
+        """If a memory is given the LSTM continues from it and the updated memory is also returned"""
+        check_memory(self, memory)
+        input = float_inputs(input, self.fc1)
         if self.recurrent:
-            x = self.lstm(input, mask=mask)
+            x, h, c = self.lstm(input, mask=mask, initial_state=lstm_initial_state(memory, self.lstm.compute_dtype))
             x = self.fc1(x)
         else:
             x = self.fc1(input)
         x = self.fc2(x)
         # x = self.fc3(x)
         x = self.a(x)
+        if memory is not None:
+            return x, lstm_memory(h, c)
         return x
 
 
 class Critic(tf.keras.Model):
-    def __init__(self, num_tasks=0, recurrent=False):
+    def __init__(self, num_tasks=0, recurrent=False, lstm_units=64, policy=None):
         super().__init__()
         self.recurrent = recurrent
+        self.memory_size = 2 * lstm_units if recurrent else 0
         if recurrent:
-            self.lstm = tf.keras.layers.RNN(tf.keras.layers.LSTMCell(64), return_sequences=True)
-        self.fc1 = tf.keras.layers.Dense(64, activation='tanh')
-        self.fc2 = tf.keras.layers.Dense(64, activation='tanh')
+            self.lstm = tf.keras.layers.RNN(
+                tf.keras.layers.LSTMCell(lstm_units, dtype=policy), return_sequences=True, return_state=True,
+                dtype=policy)
+        self.fc1 = tf.keras.layers.Dense(64, activation='tanh', dtype=policy)
+        self.fc2 = tf.keras.layers.Dense(64, activation='tanh', dtype=policy)
         # self.fc3 = tf.keras.layers.Dense(32, activation='tanh')
-        self.c = tf.keras.layers.Dense(num_tasks + 1, activation=None)
+        self.c = tf.keras.layers.Dense(num_tasks + 1, activation=None, dtype=HEAD_DTYPE)
 
-    def call(self, input, mask=None):
+    def call(self, input, mask=None, memory=None):
+        """If a memory is given the LSTM continues from it and the updated memory is also returned"""
+        check_memory(self, memory)
+        input = float_inputs(input, self.fc1)
         if self.recurrent:
-            x = self.lstm(input, mask=mask)
+            x, h, c = self.lstm(input, mask=mask, initial_state=lstm_initial_state(memory, self.lstm.compute_dtype))
             x = self.fc1(x)
         else:
             x = self.fc1(input)
         x = self.fc2(x)
         # x = self.fc3(x)
         x = self.c(x)
+        if memory is not None:
+            return x, lstm_memory(h, c)
         return x
 
 class ActorCrticLSTM(tf.keras.Model):
-    def __init__(self, num_actions, num_tasks=0, recurrent=False):
+    def __init__(self, num_actions, num_tasks=0, recurrent=False, lstm_units=64, policy=None):
         super().__init__()
         self.recurrent = recurrent
+        self.memory_size = 2 * lstm_units if recurrent else 0
         if recurrent:
-            self.lstm = tf.keras.layers.RNN(tf.keras.layers.LSTMCell(64), return_sequences=True)
-        self.afc1 = tf.keras.layers.Dense(64, activation='tanh')
+            self.lstm = tf.keras.layers.RNN(
+                tf.keras.layers.LSTMCell(lstm_units, dtype=policy), return_sequences=True, return_state=True,
+                dtype=policy)
+        self.afc1 = tf.keras.layers.Dense(64, activation='tanh', dtype=policy)
         # self.afc2 = tf.keras.layers.Dense(64, activation='tanh')
-        self.a = tf.keras.layers.Dense(num_actions, activation=None)
+        self.a = tf.keras.layers.Dense(num_actions, activation=None, dtype=HEAD_DTYPE)
 
-        self.cfc1 = tf.keras.layers.Dense(64, activation='tanh')
+        self.cfc1 = tf.keras.layers.Dense(64, activation='tanh', dtype=policy)
         # self.cfc2 = tf.keras.layers.Dense(64, activation='tanh')
-        self.c = tf.keras.layers.Dense(num_tasks + 1, activation=None)
+        self.c = tf.keras.layers.Dense(num_tasks + 1, activation=None, dtype=HEAD_DTYPE)
 
-    def call(self, input, mask=None):
+    def call(self, input, mask=None, memory=None):
+        """
+        :param input: input sequences of shape (batch, timesteps, features)
+        :param memory: the LSTM (h, c) state carried from the previous frame, shape (batch, 2 * lstm_units).
+            If given the updated memory is returned as a third output
+        """
+        check_memory(self, memory)
+        input = float_inputs(input, self.afc1)
         if self.recurrent:
-            x = self.lstm(input, mask=mask)
+            x, h, c = self.lstm(input, mask=mask, initial_state=lstm_initial_state(memory, self.lstm.compute_dtype))
         else:
             x = input
         a = self.afc1(x)
         a = self.a(a)
 
-        c = self.cfc1(x)
-        c = self.c(c)
-        return a, c
+        c_ = self.cfc1(x)
+        c_ = self.c(c_)
+        if memory is not None:
+            return a, c_, lstm_memory(h, c)
+        return a, c_
+
+
+class StackedDense(layers.Layer):
+    """Dense layer holding one set of weights per agent. Inputs carry a leading agent
+    dimension, (agents, ..., features), and all agents are evaluated with one einsum"""
+
+    def __init__(self, num_agents: int, units: int, activation=None, dtype=None):
+        super().__init__(dtype=dtype)
+        self.num_agents = num_agents
+        self.units = units
+        self.activation = tf.keras.activations.get(activation)
 
+    def build(self, input_shape):
+        self.kernel = self.add_weight(
+            name="kernel",
+            shape=[self.num_agents, int(input_shape[-1]), self.units],
+            initializer="glorot_uniform")
+        self.bias = self.add_weight(name="bias", shape=[self.num_agents, self.units], initializer="zeros")
+
+    def call(self, inputs: tf.Tensor) -> tf.Tensor:
+        x = tf.einsum('a...i,aio->a...o', inputs, self.kernel)
+        # broadcast the agent bias over the batch/time dimensions
+        bias = tf.reshape(self.bias, [self.num_agents] + [1] * (len(inputs.shape) - 2) + [self.units])
+        return self.activation(x + bias)
+
+
+class MultiAgentModel(tf.keras.Model):
+    """Base class for models which evaluate all agents in a single forward pass.
+    Inputs have shape (agents, samples, 1, features) and outputs are the stacked
+    agent (action logits, values), the same shapes MTARL.call_models produces from
+    a list of single agent models. They are not recurrent, MTARL raises a ValueError
+    if they are used with recurrence > 1"""
+
+
+class StackedActorCritic(MultiAgentModel):
+    """Actor-critic networks for all agents with weights stacked along a leading agent dimension"""
+
+    def __init__(self, num_agents: int, n_actions: int, hidden_units: List[int], num_tasks: int,
+                 name: str, activation="relu", policy=None):
+        """
+        :param num_agents: The number of agents, i.e. the number of stacked networks
+        :param n_actions: The number of actions in a model
+        :param hidden_units: The number of hidden units of each layer in the shared trunk
+        :param policy: The dtype policy of the hidden layers
+        :param name
+        """
+        super().__init__()
+        self.num_agents = num_agents
+        self.trunk = [StackedDense(num_agents, units, activation=activation, dtype=policy) for units in hidden_units]
+        self.actor = StackedDense(num_agents, n_actions, dtype=HEAD_DTYPE)
+        self.critic = StackedDense(num_agents, num_tasks + 1, dtype=HEAD_DTYPE)  # tasks + the agent
+        self.model_name = name
+
+    def call(self, inputs: tf.Tensor) -> Tuple[tf.Tensor, tf.Tensor]:
+        x = float_inputs(inputs, self.trunk[0])
+        for layer in self.trunk:
+            x = layer(x)
+        return self.actor(x), self.critic(x)
+
+    @staticmethod
+    def dense_layers(model: tf.keras.Model) -> List[layers.Dense]:
+        """The dense layers of a single agent model in the order they are applied in its forward pass"""
+        if isinstance(model, DeepActorCritic):
+            return list(model.trunk)
+        elif isinstance(model, ActorCritic):
+            return [model.fc1]
+        else:
+            raise NotImplementedError(f"Cannot stack a model of type {type(model).__name__}")
 
+    @classmethod
+    def from_models(cls, models: List[tf.keras.Model], name: str = "stacked"):
+        """Constructs a stacked model from a list of built ActorCritic or DeepActorCritic models,
+        one per agent, copying their weights."""
+        trunks = [cls.dense_layers(m) for m in models]
+        if not all(layer.built for t in trunks for layer in t):
+            raise ValueError("Models must be built (called on an input) before they can be stacked")
+        trunk = trunks[0]
+        stacked = cls(
+            num_agents=len(models),
+            n_actions=models[0].actor.units,
+            hidden_units=[layer.units for layer in trunk],
+            num_tasks=models[0].critic.units - 1,
+            name=name,
+            activation=trunk[0].activation,
+            policy=trunk[0].dtype_policy.name)
+        stacked(tf.zeros([len(models), 1, 1, trunk[0].kernel.shape[0]], dtype=tf.float32))
+        src_layers = [t + [m.actor, m.critic] for t, m in zip(trunks, models)]
+        for i, dst in enumerate(stacked.trunk + [stacked.actor, stacked.critic]):
+            # the variable values are stacked, Keras 3 variables cannot be passed to tf.stack directly
+            dst.kernel.assign(tf.stack([tf.convert_to_tensor(src[i].kernel) for src in src_layers]))
+            dst.bias.assign(tf.stack([tf.convert_to_tensor(src[i].bias) for src in src_layers]))
+        return stacked
+
+
+
+
+class SharedActorCritic(MultiAgentModel):
+    """Actor-critic network whose trunk is shared by all agents. The input of each agent is
+    concatenated with a learned agent-id embedding, and the agents are evaluated as one batch.
+    The actor/critic heads are either shared or, with per_agent_heads, one per agent"""
+
+    def __init__(self, num_agents: int, n_actions: int, hidden_units: List[int], num_tasks: int,
+                 name: str, embedding_dim=8, per_agent_heads=False, activation="relu", policy=None):
+        """
+        :param num_agents: The number of agents
+        :param n_actions: The number of actions in a model
+        :param hidden_units: The number of hidden units of each layer in the shared trunk
+        :param embedding_dim: The size of the agent-id embedding
+        :param per_agent_heads: Use a separate actor and critic head for each agent
+        :param policy: The dtype policy of the hidden layers
+        :param name
+        """
+        super().__init__()
+        self.num_agents = num_agents
+        self.agent_embedding = layers.Embedding(num_agents, embedding_dim)
+        self.trunk = [layers.Dense(units, activation=activation, dtype=policy) for units in hidden_units]
+        if per_agent_heads:
+            self.actor = StackedDense(num_agents, n_actions, dtype=HEAD_DTYPE)
+            self.critic = StackedDense(num_agents, num_tasks + 1, dtype=HEAD_DTYPE)
+        else:
+            self.actor = layers.Dense(n_actions, dtype=HEAD_DTYPE)
+            self.critic = layers.Dense(num_tasks + 1, dtype=HEAD_DTYPE)  # tasks + the agent
+        self.model_name = name
+
+    def call(self, inputs: tf.Tensor) -> Tuple[tf.Tensor, tf.Tensor]:
+        """
+        :param inputs: shape (agents, samples, 1, features)
+        :return: action logits (agents, samples, 1, actions), values (agents, samples, 1, tasks + 1)
+        """
+        embedding = self.agent_embedding(tf.range(self.num_agents))
+        # broadcast the agent embedding over the sample/time dimensions
+        embedding = tf.reshape(embedding, [self.num_agents] + [1] * (len(inputs.shape) - 2) + [-1])
+        embedding = tf.broadcast_to(embedding, tf.concat([tf.shape(inputs)[:-1], tf.shape(embedding)[-1:]], 0))
+        x = float_inputs(inputs, self.trunk[0])
+        x = tf.concat([x, tf.cast(embedding, x.dtype)], axis=-1)
+        for layer in self.trunk:
+            x = layer(x)
+        return self.actor(x), self.critic(x)
+
+
+class GridEncoder(layers.Layer):
+    """Small convolutional encoder for encoded (width, height, 3) grids. The feature maps are
+    globally max pooled, so the output size and the parameters depend on the filters and the
+    kernel size rather than on the grid area. Pooling alone would make the features translation
+    invariant, so two coordinate channels (the x and y position of each cell, scaled to [-1, 1]) are
+    appended to the grid before the convs and the pooled features can encode where objects are"""
+
+    def __init__(self, filters: List[int] = (16, 32), kernel_size=3, activation="relu", coordinates=True,
+                 dtype=None):
+        super().__init__(dtype=dtype)
+        self.coordinates = coordinates
+        self.convs = [layers.Conv2D(f, kernel_size, padding="same", activation=activation, dtype=dtype)
+                      for f in filters]
+        self.pool = layers.GlobalMaxPooling2D(dtype=dtype)
+
+    def call(self, grid: tf.Tensor) -> tf.Tensor:
+        """:param grid: shape (batch, width, height, 3)"""
+        x = tf.cast(grid, self.compute_dtype)
+        if self.coordinates:
+            xs, ys = tf.meshgrid(tf.linspace(-1.0, 1.0, grid.shape[1]), tf.linspace(-1.0, 1.0, grid.shape[2]),
+                                 indexing="ij")
+            coordinates = tf.cast(tf.stack([xs, ys], axis=-1), x.dtype)
+            coordinates = tf.broadcast_to(coordinates, tf.concat([tf.shape(x)[:1], tf.shape(coordinates)], 0))
+            x = tf.concat([x, coordinates], axis=-1)
+        for conv in self.convs:
+            x = conv(x)
+        return self.pool(x)
+
+
+class ConvActorCritic(tf.keras.Model):
+    """Actor-critic network with a convolutional grid encoder. Inputs are the flat observations
+    used everywhere else, [grid.flatten(), xDFA progress], of shape (..., features), the grid part is
+    reshaped to grid_shape and encoded, then concatenated with the progress"""
+
+    def __init__(self, n_actions: int, hidden_units: int, num_tasks: int, name: str, grid_shape: Tuple[int, int, int],
+                 filters: List[int] = (16, 32), kernel_size=3, activation="relu", coordinates=True, policy=None):
+        """
+        :param n_actions: The number of actions in a model
+        :param hidden_units: The number of hidden units
+        :param grid_shape: The shape of the encoded grid, (width, height, 3)
+        :param filters: The number of filters of each conv layer
+        :param kernel_size: The conv kernel size
+        :param coordinates: Append the cell coordinate channels to the grid, see GridEncoder
+        :param policy: The dtype policy of the hidden layers
+        :param name
+        """
+        super().__init__()
+        self.grid_shape = list(grid_shape)
+        self.grid_size = int(grid_shape[0] * grid_shape[1] * grid_shape[2])
+        self.encoder = GridEncoder(filters, kernel_size, activation=activation, coordinates=coordinates,
+                                   dtype=policy)
+        self.fc1 = layers.Dense(hidden_units, activation=activation, dtype=policy)
+        self.actor = layers.Dense(n_actions, dtype=HEAD_DTYPE)
+        self.critic = layers.Dense(num_tasks + 1, dtype=HEAD_DTYPE)  # tasks + the agent
+        self.model_name = name
+
+    def call(self, inputs: tf.Tensor) -> Tuple[tf.Tensor, tf.Tensor]:
+        # fold the leading (samples, time, ...) dimensions into one batch dimension for the convs
+        lead_shape = tf.shape(inputs)[:-1]
+        x = tf.reshape(inputs, [-1, inputs.shape[-1]])
+        grid = tf.reshape(x[:, :self.grid_size], [-1] + self.grid_shape)
+        features = self.encoder(grid)
+        x = tf.concat([features, tf.cast(x[:, self.grid_size:], features.dtype)], axis=-1)
+        x = self.fc1(x)
+        action_logits, values = self.actor(x), self.critic(x)
+        return (tf.reshape(action_logits, tf.concat([lead_shape, [self.actor.units]], 0)),
+                tf.reshape(values, tf.concat([lead_shape, [self.critic.units]], 0)))
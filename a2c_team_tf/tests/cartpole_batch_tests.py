@@ -0,0 +1,50 @@
+# Steps a CartPoleBatch next to the gym CartPoleDefault and CartPoleHeavyLong envs it is built from
+# with the same actions, and checks that the states the carts fail in, the done flags and the rewards match
+# Run with: python a2c_team_tf/tests/cartpole_batch_tests.py
+
+import gym
+import numpy as np
+from a2c_team_tf.envs.cartpole_ma import CartPoleBatch, CartPoleDefault, CartPoleHeavyLong
+
+num_steps = 2000
+
+envs = [gym.make('CartPole-default-v0'), gym.make('CartPole-heavy-long-v0')]
+assert isinstance(envs[0].unwrapped, CartPoleDefault) and isinstance(envs[1].unwrapped, CartPoleHeavyLong)
+batch = CartPoleBatch.from_envs(envs, seed=0)
+np.testing.assert_array_equal(batch.reward, [-1.0, 1.0])
+
+
+def restart(env, state):
+    """Starts a new episode of the gym env from the batch cart's initial state"""
+    env.reset()
+    env.unwrapped.state = state.astype(np.float64)
+
+
+states = batch.reset()
+for env, state in zip(envs, states):
+    restart(env, state)
+rng = np.random.RandomState(0)
+num_dones = np.zeros(len(envs), dtype=int)
+for step in range(num_steps):
+    actions = rng.randint(2, size=len(envs))
+    states, rewards, dones, info = batch.step(actions)
+    for k, env in enumerate(envs):
+        # the unwrapped env, the gym TimeLimit would end the episodes the batch does not limit
+        state, reward, done, _ = env.unwrapped.step(actions[k])
+        np.testing.assert_allclose(info['terminal_observation'][k], state, rtol=1e-5, atol=1e-6,
+                                   err_msg=f"cart {k} step {step}")
+        assert dones[k] == done, (k, step)
+        assert rewards[k] == reward, (k, step, rewards[k], reward)
+        if done:
+            num_dones[k] += 1
+            restart(env, states[k])
+assert np.all(num_dones > 0), num_dones
+print(f"{num_steps} steps match, {num_dones} episodes ended")
+
+# the reward of an env without a step_reward is not guessed
+try:
+    CartPoleBatch.from_envs([gym.make('CartPole-v1')])
+    raise AssertionError("an env without a step_reward was accepted")
+except ValueError as e:
+    print(f"no step_reward: {e}")
+np.testing.assert_array_equal(CartPoleBatch.from_envs([gym.make('CartPole-v1')], reward=1.0).reward, [1.0])
@@ -0,0 +1,62 @@
+# Shared set up of the MTARL test scripts: a CartPoleTeam env per process and two tasks per agent,
+# move the cart right of 0.5 or left of -0.5
+
+import copy
+import tensorflow as tf
+from a2c_team_tf.lib.tf2_a2c_base_v2 import MTARL
+from a2c_team_tf.envs.cartpole_ma import CartPoleTeam
+from a2c_team_tf.utils.dfa import DFA, CrossProductDFA
+
+num_tasks = 2
+
+
+def cart_right(data, agent):
+    return "P" if data['env'].state[agent][0] > 0.5 else "I"
+
+
+def cart_left(data, agent):
+    return "P" if data['env'].state[agent][0] < -0.5 else "I"
+
+
+def finished(data, agent):
+    return "P"
+
+
+def make_dfa(f):
+    dfa = DFA(start_state="I", acc=["P"], rej=[])
+    dfa.add_state("I", f)
+    dfa.add_state("P", finished)
+    return dfa
+
+
+def make_xdfas(num_agents, num_procs):
+    """One xDFA per agent and process, each tracking its own agent's cart"""
+    xdfa = CrossProductDFA(num_tasks=num_tasks, dfas=[make_dfa(cart_right), make_dfa(cart_left)], agent=0)
+    xdfas = []
+    for _ in range(num_procs):
+        xdfas.append([copy.deepcopy(xdfa) for _ in range(num_agents)])
+        for agent, d in enumerate(xdfas[-1]):
+            d.agent = agent
+    return xdfas
+
+
+def make_mtarl(num_agents, num_procs, num_frames_per_proc, max_steps=200, **kwargs) -> MTARL:
+    """
+    :param max_steps: the CartPoleTeam episode length
+    :param kwargs: further MTARL arguments, e.g. ppo=True
+    """
+    envs = [CartPoleTeam(num_agents, max_steps=max_steps) for _ in range(num_procs)]
+    return MTARL(envs, num_agents, num_tasks, make_xdfas(num_agents, num_procs), one_off_reward=1.0, e=0.8,
+                 c=-50., chi=1.0, lam=1.0, num_procs=num_procs, num_frames_per_proc=num_frames_per_proc, **kwargs)
+
+
+def initial_inputs(mtarl: MTARL):
+    """
+    Resets the envs
+    :return: the model inputs (agents, procs, 1, features), log rewards, mu and the agent indices
+    """
+    state = tf.squeeze(mtarl.tf_reset2())
+    state = tf.expand_dims(tf.transpose(state, perm=[1, 0, 2]), 2)
+    log_reward = tf.zeros([mtarl.num_agents, mtarl.num_procs, num_tasks + 1], dtype=tf.float32)
+    mu = tf.nn.softmax(tf.ones([mtarl.num_agents, num_tasks]), axis=0)
+    return state, log_reward, mu, mtarl.tf_1d_indices()
@@ -0,0 +1,52 @@
+# Checks that ConvActorCritic keeps the positions of objects on the grid: the actor is trained to
+# output the direction of a goal which is at least 5 cells away from the agent, so that they are never in the
+# same 5x5 receptive field of the convs. Both are also at least 5 cells away from the side walls, so no feature sees
+# an object and a wall and a translation invariant encoder (coordinates=False) cannot do better than chance
+# Run with: python a2c_team_tf/tests/conv_encoder_tests.py
+
+import numpy as np
+import tensorflow as tf
+from a2c_team_tf.nets.base import ConvActorCritic
+
+width, height, num_tasks = 19, 7, 2
+EMPTY, WALL, GOAL, AGENT = 1, 2, 8, 10  # minigrid object indices
+
+
+def make_batch(rng: np.random.RandomState, size: int):
+    """Flat [grid, xDFA progress] observations and labels, 0 if the goal is left of the agent, 1 if it is right"""
+    grids = np.zeros((size, width, height, 3), dtype=np.float32)
+    grids[..., 0] = EMPTY
+    grids[:, [0, -1], :, 0] = WALL
+    grids[:, :, [0, -1], 0] = WALL
+    labels = rng.randint(2, size=size)
+    for grid, label in zip(grids, labels):
+        agent_x, goal_x = sorted(rng.choice(np.arange(5, width - 5), size=2, replace=False))
+        while goal_x - agent_x < 5:
+            agent_x, goal_x = sorted(rng.choice(np.arange(5, width - 5), size=2, replace=False))
+        if not label:
+            agent_x, goal_x = goal_x, agent_x
+        grid[agent_x, rng.randint(1, height - 1), 0] = AGENT
+        grid[goal_x, rng.randint(1, height - 1), 0] = GOAL
+    progress = np.zeros((size, num_tasks), dtype=np.float32)
+    return np.concatenate([grids.reshape(size, -1), progress], axis=1), labels
+
+
+def accuracy(coordinates: bool, steps=400, seed=0) -> float:
+    tf.random.set_seed(seed)
+    rng = np.random.RandomState(seed)
+    model = ConvActorCritic(2, 32, num_tasks, name="agent0", grid_shape=(width, height, 3), coordinates=coordinates)
+    opt = tf.keras.optimizers.Adam(learning_rate=3e-3)
+    for _ in range(steps):
+        x, y = make_batch(rng, 64)
+        with tf.GradientTape() as tape:
+            action_logits, _ = model(x)
+            loss = tf.reduce_mean(tf.keras.losses.sparse_categorical_crossentropy(y, action_logits, from_logits=True))
+        grads = tape.gradient(loss, model.trainable_variables)
+        opt.apply_gradients([(g, v) for g, v in zip(grads, model.trainable_variables) if g is not None])
+    x, y = make_batch(rng, 1000)
+    return float(np.mean(np.argmax(model(x)[0], axis=-1) == y))
+
+
+with_coordinates, without_coordinates = accuracy(True), accuracy(False)
+print(f"goal direction accuracy: coordinates {with_coordinates:.3f}, translation invariant {without_coordinates:.3f}")
+assert with_coordinates > 0.9, with_coordinates
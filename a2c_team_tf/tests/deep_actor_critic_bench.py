@@ -0,0 +1,60 @@
+# Benchmarks the per-frame forward cost of DeepActorCritic against the previous trunk, which
+# applied the TimeDistributed fc1 layer twice and masked every input
+# Run with: python a2c_team_tf/tests/deep_actor_critic_bench.py
+
+import timeit
+import tensorflow as tf
+from tensorflow.keras import layers
+from typing import Tuple
+from a2c_team_tf.nets.base import DeepActorCritic
+
+
+class LegacyDeepActorCritic(tf.keras.Model):
+    """The DeepActorCritic trunk before the rework, kept for comparison"""
+
+    def __init__(self, n_actions: int, hidden_units: int, num_tasks: int,
+                 name: str, feature_set: int, activation="relu"):
+        super().__init__()
+        self.mask = layers.Masking()
+        self.fc1 = layers.TimeDistributed(layers.Dense(feature_set, activation=activation))
+        self.fc2 = layers.Dense(hidden_units, activation=activation)
+        self.actor = layers.Dense(n_actions)
+        self.critic = layers.Dense(num_tasks + 1)
+        self.model_name = name
+
+    def call(self, inputs: tf.Tensor) -> Tuple[tf.Tensor, tf.Tensor]:
+        embedding = self.mask(inputs)
+        x = self.fc1(embedding)
+        x = self.fc1(x)
+        x = self.fc2(x)
+        return self.actor(x), self.critic(x)
+
+
+num_procs = 10  # samples per frame, one per parallel env
+num_agents = 2
+feature_set = 150  # e.g. a flattened 7x7x3 grid observation plus the xDFA progress
+n_actions, hidden_units, num_tasks = 7, 64, 2
+number, repeat = 200, 5
+
+state = tf.random.uniform([num_procs, 1, feature_set])
+benchmarks = {
+    "legacy": [LegacyDeepActorCritic(n_actions, hidden_units, num_tasks, f"agent{i}", feature_set, "tanh")
+               for i in range(num_agents)],
+    "depth=1": [DeepActorCritic(n_actions, hidden_units, num_tasks, f"agent{i}", feature_set, "tanh")
+                for i in range(num_agents)],
+    "depth=2": [DeepActorCritic(n_actions, hidden_units, num_tasks, f"agent{i}", feature_set, "tanh", depth=2)
+                for i in range(num_agents)],
+}
+
+print(f"Forward cost per frame, {num_agents} agents x {num_procs} samples x {feature_set} features")
+for key, models in benchmarks.items():
+    @tf.function
+    def frame():
+        return [m(state) for m in models]
+
+    frame()  # build and trace
+    # best of several repeats to reduce the noise from other processes
+    eager = min(timeit.repeat(lambda: [m(state) for m in models], number=number, repeat=repeat)) / number
+    graph = min(timeit.repeat(frame, number=number, repeat=repeat)) / number
+    params = sum(m.count_params() for m in models)
+    print(f"{key:>8}: eager {eager * 1e6:8.1f} us, tf.function {graph * 1e6:8.1f} us, params {params}")
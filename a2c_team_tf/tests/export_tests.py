@@ -0,0 +1,31 @@
+# Checks that the frozen .pb and the quantised .tflite exports of the agent models compute the same
+# outputs as the models, the .tflite exports within the error of the int8 weight quantisation
+# Run with: python a2c_team_tf/tests/export_tests.py
+
+import tempfile
+import numpy as np
+import tensorflow as tf
+from a2c_team_tf.nets.base import ActorCritic, DeepActorCritic
+from a2c_team_tf.utils.export import export_team, FrozenPolicy
+
+num_features, num_actions, num_tasks = 150, 7, 2
+tf.random.set_seed(0)
+models = [DeepActorCritic(num_actions, 64, num_tasks, name="agent0", feature_set=num_features, activation="tanh"),
+          ActorCritic(num_actions, 64, num_tasks, name="agent1")]
+observations = np.random.RandomState(0).randint(0, 11, size=(20, 1, 1, num_features)).astype(np.float32)
+expected = [[[o.numpy() for o in m(x)] for x in observations] for m in models]
+
+directory = tempfile.mkdtemp()
+for quantize, tolerance in [(False, 1e-5), (True, 0.05)]:
+    paths = export_team(models, (1, 1, num_features), directory, quantize=quantize)
+    for path, outputs in zip(paths, expected):
+        policy = FrozenPolicy(path)
+        errors = []
+        for x, (action_logits, values) in zip(observations, outputs):
+            exported_logits, exported_values = policy(x)
+            assert np.all(np.isfinite(exported_logits)) and np.all(np.isfinite(exported_values)), path
+            scale = max(np.abs(action_logits).max(), np.abs(values).max(), 1.0)
+            errors.append(max(np.abs(exported_logits - action_logits).max(),
+                              np.abs(exported_values - values).max()) / scale)
+        assert max(errors) < tolerance, (path, max(errors))
+        print(f"{path}: max relative error {max(errors):.2e}")
@@ -0,0 +1,52 @@
+# Runs mixed float16 updates of MTARL with loss scaling, and checks that the agent leaves the
+# global Keras dtype policy unchanged, rejects unknown mixed_precision options and models built with
+# another policy
+# Run with: python a2c_team_tf/tests/mixed_precision_tests.py
+
+import numpy as np
+import tensorflow as tf
+from a2c_team_tf.nets.base import DeepActorCritic
+from a2c_team_tf.tests.cartpole_team_setup import make_mtarl, initial_inputs, num_tasks
+
+num_agents, num_procs, num_frames_per_proc = 2, 2, 16
+
+global_policy = tf.keras.mixed_precision.global_policy().name
+mtarl = make_mtarl(num_agents, num_procs, num_frames_per_proc, max_steps=10, seed=3, lr=1e-2,
+                   mixed_precision="mixed_float16")
+assert tf.keras.mixed_precision.global_policy().name == global_policy
+state, log_reward, mu, ii = initial_inputs(mtarl)
+models = [DeepActorCritic(2, 32, num_tasks, name=f"agent{i}", feature_set=state.shape[-1], policy="mixed_float16")
+          for i in range(num_agents)]
+assert models[0].trunk[0].compute_dtype == "float16"
+for accumulate_steps in (1, 2):
+    models[0](state[0])
+    weights = [w.numpy().copy() for w in models[0].trainable_variables]
+    # an update whose scaled gradients overflow is skipped and the loss scale is lowered, retry until one is applied
+    for _ in range(20):
+        state, log_reward, running_rewards, loss, ini_values = \
+            mtarl.train(state, log_reward, ii, mu, *models, accumulate_steps=accumulate_steps)
+        assert np.all(np.isfinite(loss.numpy())), loss
+        if any(np.any(w != v.numpy()) for w, v in zip(weights, models[0].trainable_variables)):
+            break
+    else:
+        raise AssertionError("no float16 update was applied")
+    for v in models[0].trainable_variables:
+        assert v.dtype == tf.float32 and np.all(np.isfinite(v.numpy())), v.name
+    print(f"accumulate_steps={accumulate_steps}: float16 update applied, loss {loss.numpy()}")
+
+try:
+    make_mtarl(num_agents, num_procs, num_frames_per_proc, mixed_precision="float16")
+    raise AssertionError("mixed_precision='float16' was accepted")
+except ValueError as e:
+    print(f"unknown option: {e}")
+
+# models whose policy does not match mixed_precision are rejected on their first call
+for mixed_precision, policy in [("mixed_float16", None), (None, "mixed_float16"), ("mixed_bfloat16", "mixed_float16")]:
+    mtarl = make_mtarl(num_agents, num_procs, num_frames_per_proc, mixed_precision=mixed_precision)
+    models = [DeepActorCritic(2, 32, num_tasks, name=f"agent{i}", feature_set=state.shape[-1], policy=policy)
+              for i in range(num_agents)]
+    try:
+        mtarl.call_models(state, *models)
+        raise AssertionError(f"{policy} models were accepted with mixed_precision={mixed_precision}")
+    except ValueError as e:
+        print(f"mismatched policy: {e}")
@@ -0,0 +1,28 @@
+# Checks that a StackedActorCritic built from per agent models computes the same outputs as the
+# per agent models, and that a MultiAgentModel is rejected with recurrence > 1
+# Run with: python a2c_team_tf/tests/multi_agent_model_tests.py
+
+import numpy as np
+import tensorflow as tf
+from a2c_team_tf.nets.base import ActorCritic, DeepActorCritic, StackedActorCritic
+from a2c_team_tf.tests.cartpole_team_setup import make_mtarl, num_tasks
+
+num_agents, num_actions, num_samples, num_features = 3, 2, 5, 6
+
+tf.random.set_seed(0)
+state = tf.random.uniform([num_agents, num_samples, 1, num_features])
+for cls, kwargs in [(ActorCritic, {}), (DeepActorCritic, {'feature_set': num_features, 'depth': 2})]:
+    models = [cls(num_actions, 16, num_tasks, name=f"agent{i}", **kwargs) for i in range(num_agents)]
+    outputs = [m(state[i]) for i, m in enumerate(models)]
+    stacked = StackedActorCritic.from_models(models)
+    action_logits, values = stacked(state)
+    np.testing.assert_allclose(action_logits.numpy(), np.stack([o[0] for o in outputs]), rtol=1e-5, atol=1e-5)
+    np.testing.assert_allclose(values.numpy(), np.stack([o[1] for o in outputs]), rtol=1e-5, atol=1e-5)
+    print(f"{cls.__name__}: stacked outputs match")
+
+mtarl = make_mtarl(num_agents, num_procs=1, num_frames_per_proc=4, recurrence=2)
+try:
+    mtarl.initial_memories(num_samples, stacked)
+    raise AssertionError("a MultiAgentModel was accepted with recurrence > 1")
+except ValueError as e:
+    print(f"recurrence > 1: {e}")
@@ -0,0 +1,48 @@
+# Compares the FlatObsWrapper observations with a full encoding of the grid over random rollouts:
+# the default wrapper on an env with moving obstacles, and incremental=True on an env where only
+# the agent's actions change the grid
+# Run with: python a2c_team_tf/tests/obs_wrapper_tests.py
+
+import gym
+import gym_minigrid
+import numpy as np
+from gym_minigrid.minigrid import OBJECT_TO_IDX, COLOR_TO_IDX
+from a2c_team_tf.utils.obs_wrapper import FlatObsWrapper
+
+num_steps = 500
+
+
+def full_encoding(env):
+    grid = env.grid.encode()
+    grid[tuple(env.agent_pos)] = (OBJECT_TO_IDX['agent'], COLOR_TO_IDX['red'], env.agent_dir)
+    return grid.flatten()
+
+
+for env_key, kwargs in [('MiniGrid-Dynamic-Obstacles-5x5-v0', {}),
+                        ('MiniGrid-DoorKey-5x5-v0', {'incremental': True})]:
+    env = FlatObsWrapper(gym.make(env_key), max_steps=50, **kwargs)
+    env.seed(0)
+    rng = np.random.RandomState(0)
+    obs = env.reset()
+    episodes = 0
+    for step in range(num_steps):
+        assert np.array_equal(obs, full_encoding(env.unwrapped)), (env_key, step)
+        obs, _, done, _ = env.step(rng.randint(env.action_space.n))
+        if done:
+            assert np.array_equal(obs, full_encoding(env.unwrapped)), (env_key, step)
+            obs = env.reset()
+            episodes += 1
+    print(f"{env_key} {kwargs}: {num_steps} steps ({episodes} episodes) match the full encoding")
+
+# the cached encoding misses the obstacles moving, so incremental=True must not be the default
+env = FlatObsWrapper(gym.make('MiniGrid-Dynamic-Obstacles-5x5-v0'), max_steps=50, incremental=True)
+env.seed(0)
+rng = np.random.RandomState(0)
+obs, mismatch = env.reset(), False
+for _ in range(num_steps):
+    obs, _, done, _ = env.step(rng.randint(env.action_space.n))
+    mismatch |= not np.array_equal(obs, full_encoding(env.unwrapped))
+    if done:
+        obs = env.reset()
+assert mismatch, "incremental=True was expected to miss the moving obstacles"
+print("MiniGrid-Dynamic-Obstacles-5x5-v0 {'incremental': True}: stale cells detected")
@@ -0,0 +1,31 @@
+# Checks that the PPO probability ratio is 1 on every frame of a collected batch before the first
+# gradient step, including the episode final frames whose observations are masked in A2C updates
+# Run with: python a2c_team_tf/tests/ppo_tests.py
+
+import numpy as np
+import tensorflow as tf
+from a2c_team_tf.nets.base import DeepActorCritic
+from a2c_team_tf.lib.sampling import log_probs_entropy
+from a2c_team_tf.tests.cartpole_team_setup import make_mtarl, initial_inputs, num_tasks
+
+num_agents, num_procs, num_frames_per_proc = 2, 2, 32
+
+# short episodes, so that the batch contains several episode final frames
+mtarl = make_mtarl(num_agents, num_procs, num_frames_per_proc, max_steps=5, seed=3, ppo=True)
+state, log_reward, mu, ii = initial_inputs(mtarl)
+models = [DeepActorCritic(2, 32, num_tasks, name=f"agent{i}", feature_set=state.shape[-1])
+          for i in range(num_agents)]
+
+observations, acts, masks, returns, values, advantages, state, log_reward, running_rewards, ini_values, \
+    old_log_probs, memories = mtarl.train_preprocess(state, log_reward, ii, mu, *models)
+assert np.any(masks.numpy() == 0), "the batch has no episode final frames"
+action_logits, _, _, _ = mtarl.evaluate_sub_batch(observations, masks, ii, *models, ppo=True)
+log_probs, _ = log_probs_entropy(action_logits, tf.gather(acts, ii, axis=1))
+log_ratio = (log_probs - tf.gather(old_log_probs, ii, axis=1)).numpy()
+assert np.abs(log_ratio).max() < 1e-5, np.abs(log_ratio).max()
+print(f"max |log ratio| before the first update: {np.abs(log_ratio).max():.2e} "
+      f"({int(np.sum(masks.numpy() == 0))} episode final frames)")
+
+loss = mtarl.ppo_update(observations, acts, masks, returns, advantages, old_log_probs, ii, *models)
+assert np.all(np.isfinite(loss.numpy()))
+print(f"ppo update loss: {loss.numpy()}")
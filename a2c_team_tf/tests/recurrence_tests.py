@@ -0,0 +1,47 @@
+# Checks the truncated BPTT path of MTARL: the LSTM memories stored during collection, unrolled from each
+# chunk start over the recurrence frames as in update_loss, reproduce the behaviour log probs of every frame,
+# including the frames after an episode reset and the second batch which starts from carried memories
+# Run with: python a2c_team_tf/tests/recurrence_tests.py
+
+import numpy as np
+import tensorflow as tf
+from a2c_team_tf.nets.base import ActorCrticLSTM
+from a2c_team_tf.lib.sampling import log_probs_entropy
+from a2c_team_tf.tests.cartpole_team_setup import make_mtarl, initial_inputs, num_tasks
+
+num_agents, num_procs, num_frames_per_proc, recurrence = 2, 2, 32, 4
+
+# episodes shorter than a chunk, so that memories are reset inside the chunks
+mtarl = make_mtarl(num_agents, num_procs, num_frames_per_proc, max_steps=6, seed=3, recurrence=recurrence)
+state, log_reward, mu, ii = initial_inputs(mtarl)
+models = [ActorCrticLSTM(2, num_tasks, recurrent=True, lstm_units=16) for _ in range(num_agents)]
+
+for batch in range(2):
+    observations, acts, masks, returns, values, advantages, state, log_reward, running_rewards, ini_values, \
+        old_log_probs, memories = mtarl.train_preprocess(state, log_reward, ii, mu, *models)
+    assert np.any(masks.numpy() == 0), "the batch has no episode final frames"
+    # the frames are (sample, frame) ordered, the chunk starts ii must not cross into another sample
+    chunk_masks = tf.gather(masks, ii[:, None] + tf.range(recurrence - 1)[None]).numpy()
+    assert np.any(chunk_masks == 0), "no episode ends inside a chunk"
+    assert np.any(tf.gather(memories, ii, axis=1).numpy() != 0), "no chunk starts from a carried memory"
+    memory = tf.gather(memories, ii, axis=1)
+    log_ratios = []
+    for t in range(recurrence):
+        action_logits, _, _, memory = mtarl.evaluate_sub_batch(observations, masks, ii + t, *models, memory=memory)
+        log_probs, _ = log_probs_entropy(action_logits, tf.gather(acts, ii + t, axis=1))
+        log_ratios.append((log_probs - tf.gather(old_log_probs, ii + t, axis=1)).numpy())
+    max_log_ratio = np.abs(log_ratios).max()
+    assert max_log_ratio < 1e-5, (batch, max_log_ratio)
+    print(f"batch {batch}: max |log ratio| of the unrolled chunks {max_log_ratio:.2e} "
+          f"({int(np.sum(masks.numpy() == 0))} episode final frames)")
+
+loss = mtarl.update_loss(observations, acts, masks, returns, advantages, ii, *models, memories=memories)
+assert np.all(np.isfinite(loss.numpy()))
+print(f"truncated BPTT loss: {loss.numpy()}")
+
+# a memory passed to a model without an LSTM is an error
+try:
+    ActorCrticLSTM(2, num_tasks, recurrent=False)(observations[0, :4], memory=memories[0, :4])
+    raise AssertionError("a memory was accepted by a model built with recurrent=False")
+except ValueError as e:
+    print(f"recurrent=False: {type(e).__name__} raised")
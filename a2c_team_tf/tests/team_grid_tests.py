@@ -192,7 +192,7 @@ state, reward, done = agent.tf_render_env_step(actions)
 #agent.render_episode(r_init_state, 500, *models)
 ##
 log_rewards = tf.zeros([num_agents, num_procs, num_tasks + 1], dtype=tf.float32)
-actions, observations, values, rewards, masks, state_, running_rewards, log_rewards = \
+actions, observations, values, rewards, masks, state_, running_rewards, log_rewards, log_probs, memories = \
      agent.collect_batch(initial_states, log_rewards, *models)
 print("action shape ", actions.shape)
 print("observations shape ", observations.shape)
@@ -202,6 +202,7 @@ print("masks shape ", masks.shape)
 print("state shape ", state_.shape)
 print("running rewards shape ", running_rewards.shape)
 print("log rewards shape ", log_rewards.shape)
+print("log probs shape ", log_probs.shape)
 indices = agent.tf_1d_indices()
 state = initial_states
 state, log_rewards, running_rewards, loss, ini_values = agent.train(state, log_rewards, indices, mu, *models)
@@ -0,0 +1,76 @@
+# Checks the V-trace targets of MTARL against the bootstrapped discounted returns, and runs the
+# decoupled ActorLearner: learner updates from the actor thread's trajectories, and an exception in
+# the actor thread re-raised by the learner
+# Run with: python a2c_team_tf/tests/vtrace_tests.py
+
+import numpy as np
+import tensorflow as tf
+from a2c_team_tf.nets.base import DeepActorCritic
+from a2c_team_tf.lib.actor_learner import ActorLearner
+from a2c_team_tf.tests.cartpole_team_setup import make_mtarl, initial_inputs, num_tasks
+
+num_agents, num_procs, num_frames_per_proc, gamma = 2, 3, 12, 0.9
+
+mtarl = make_mtarl(num_agents, num_procs, num_frames_per_proc, max_steps=5, seed=3, gamma=gamma)
+rng = np.random.RandomState(0)
+shape = (num_frames_per_proc, num_agents, num_procs, num_tasks + 1)
+rewards = rng.normal(size=shape).astype(np.float32)
+values = rng.normal(size=shape).astype(np.float32)
+bootstrap_value = rng.normal(size=shape[1:]).astype(np.float32)
+masks = (rng.uniform(size=(num_frames_per_proc, num_procs)) > 0.25).astype(np.float32)
+assert np.any(masks == 0)
+
+# on-policy (rho = c = 1 with rho_bar = c_bar = 1) the targets are the n-step returns bootstrapped from the
+# value after the last frame, which stop at the episode ends
+expected = np.zeros(shape, dtype=np.float32)
+acc = bootstrap_value
+for t in reversed(range(num_frames_per_proc)):
+    acc = rewards[t] + gamma * masks[t][None, :, None] * acc
+    expected[t] = acc
+vs, pg_returns = mtarl.get_vtrace_returns(rewards, values, bootstrap_value, masks,
+                                          tf.zeros(shape[:3], dtype=tf.float32))
+np.testing.assert_allclose(vs.numpy(), expected, rtol=1e-5, atol=1e-5)
+np.testing.assert_allclose(pg_returns.numpy(), expected, rtol=1e-5, atol=1e-5)
+t, s = np.nonzero(masks == 0)
+np.testing.assert_allclose(vs.numpy()[t, :, s], rewards[t, :, s], rtol=1e-6, atol=1e-6)
+print(f"on-policy V-trace targets match the discounted returns ({len(t)} episode ends)")
+
+# with vanishing importance weights the targets fall back to the values
+vs, _ = mtarl.get_vtrace_returns(rewards, values, bootstrap_value, masks, tf.fill(shape[:3], -50.0))
+np.testing.assert_allclose(vs.numpy(), values, rtol=1e-5, atol=1e-5)
+print("off-policy V-trace targets fall back to the values")
+
+state, log_reward, mu, ii = initial_inputs(mtarl)
+learner_models = [DeepActorCritic(2, 32, num_tasks, name=f"learner{i}", feature_set=state.shape[-1])
+                  for i in range(num_agents)]
+actor_models = [DeepActorCritic(2, 32, num_tasks, name=f"actor{i}", feature_set=state.shape[-1])
+                for i in range(num_agents)]
+for i in range(num_agents):
+    learner_models[i](state[i])
+    actor_models[i](state[i])
+weights = [w.numpy().copy() for w in learner_models[0].trainable_variables]
+actor_learner = ActorLearner(mtarl, learner_models, actor_models, state, log_reward)
+actor_learner.start()
+for _ in range(3):
+    running_rewards, loss, ini_values = actor_learner.step(mu)
+    assert np.all(np.isfinite(loss.numpy())), loss
+actor_learner.stop()
+assert not actor_learner.thread.is_alive()
+assert any(np.any(w != v.numpy()) for w, v in zip(weights, learner_models[0].trainable_variables))
+print(f"actor-learner: 3 V-trace updates, loss {loss.numpy()}")
+
+
+def failing_collect_batch(*args):
+    raise RuntimeError("collection failed")
+
+
+# an actor thread failure reaches the learner instead of blocking it on an empty queue
+mtarl.collect_batch = failing_collect_batch
+actor_learner = ActorLearner(mtarl, learner_models, actor_models, actor_learner.state, actor_learner.log_reward)
+actor_learner.start()
+try:
+    actor_learner.step(mu)
+    raise AssertionError("the actor thread exception was not re-raised")
+except RuntimeError as e:
+    print(f"actor thread exception re-raised: {e}")
+actor_learner.stop()
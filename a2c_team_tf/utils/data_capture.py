@@ -1,44 +1,281 @@
-from multiprocessing import Process, Pipe
+from multiprocessing import Process, Queue
+import atexit
+import json
+import queue
 import os
+import time
 import numpy as np
+from typing import Iterator
 
 
-def worker(conn, path1, path2, num_agents, num_tasks):
+class ChunkedWriter:
+    """
+    Buffers rows in memory and appends them to a binary file in blocks. Each block is written
+    as a .npy array, so the file is a sequence of (rows, columns) .npy chunks which is only ever
+    appended to, see read_chunks and load_chunked. A block is flushed when block_size rows are
+    buffered or when flush_interval seconds have passed since the last flush.
+    """
+
+    def __init__(self, fname: str, num_columns: int, block_size=256, flush_interval=10.0, dtype=np.float32,
+                 append=False):
+        """
+        :param fname: the output file, e.g. data/exp-learning.npy
+        :param append: keep the existing contents of the file, otherwise it is truncated
+        """
+        self.fname = fname
+        self.block_size = block_size
+        self.flush_interval = flush_interval
+        self.buffer = np.zeros((block_size, num_columns), dtype=dtype)
+        self.num_rows = 0
+        self.last_flush = time.time()
+        if not append:
+            open(fname, "wb").close()
+
+    def append(self, row: np.ndarray):
+        self.buffer[self.num_rows] = np.ravel(row)
+        self.num_rows += 1
+        if self.num_rows == self.block_size:
+            self.flush()
+
+    def extend(self, rows: np.ndarray):
+        """Appends a block of rows, shape (rows, columns)"""
+        while len(rows):
+            n = min(len(rows), self.block_size - self.num_rows)
+            self.buffer[self.num_rows:self.num_rows + n] = rows[:n]
+            self.num_rows += n
+            rows = rows[n:]
+            if self.num_rows == self.block_size:
+                self.flush()
+
+    def flush_due(self) -> bool:
+        return self.num_rows > 0 and time.time() - self.last_flush >= self.flush_interval
+
+    def flush(self):
+        if self.num_rows:
+            with open(self.fname, "ab") as f:
+                np.save(f, self.buffer[:self.num_rows])
+            self.num_rows = 0
+        self.last_flush = time.time()
+
+
+def read_chunks(fname: str) -> Iterator[np.ndarray]:
+    """Yields the blocks of a file written by ChunkedWriter one at a time. A partially written
+    last block, e.g. one which is being written or was cut off by a crash, is skipped"""
+    with open(fname, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        while f.tell() < size:
+            try:
+                yield np.load(f)
+            except (ValueError, EOFError):
+                return
+
+
+def recover_chunked(fname: str) -> np.ndarray:
+    """
+    Truncates a file written by ChunkedWriter after its last complete block, so that it can be
+    appended to again after a crash
+    :return: the last complete block, None if there is none
+    """
+    last, end = None, 0
+    with open(fname, "r+b") as f:
+        size = os.fstat(f.fileno()).st_size
+        while f.tell() < size:
+            try:
+                last = np.load(f)
+            except (ValueError, EOFError):
+                break
+            end = f.tell()
+        f.truncate(end)
+    return last
+
+
+def load_chunked(fname: str) -> np.ndarray:
+    """All of the rows of a file written by ChunkedWriter, shape (rows, columns)"""
+    chunks = list(read_chunks(fname))
+    return np.concatenate(chunks) if chunks else np.zeros((0, 0), dtype=np.float32)
+
+
+def to_csv(fname: str, csv_fname: str = None) -> str:
+    """Converts a file written by ChunkedWriter into the comma separated text written by np.savetxt"""
+    csv_fname = csv_fname or f"{os.path.splitext(fname)[0]}.csv"
+    with open(csv_fname, "wb") as f:
+        for chunk in read_chunks(fname):
+            np.savetxt(f, chunk, delimiter=',')
+    return csv_fname
+
+
+def worker(messages: Queue, path1, path2, num_agents, num_tasks, block_size, flush_interval):
+    writers = {
+        'learn': ChunkedWriter(path1, num_agents * (1 + num_tasks), block_size, flush_interval, append=True),
+        'alloc': ChunkedWriter(path2, num_agents * num_tasks, block_size, flush_interval, append=True)}
     while True:
-        cmd, data = conn.recv()
-        # data will be type dictionary with attributes learn, alloc
-        # append the data to a file
+        # wake up at least once per flush interval so buffered rows reach the disk when training is slow
+        try:
+            cmd, data = messages.get(timeout=flush_interval)
+        except queue.Empty:
+            cmd, data = None, None
+        # data will be type dictionary with blocks of learn, alloc rows
+        # append the data to the buffers
         if cmd == 'write':
-            data_2d_learn = np.reshape(data['learn'], (1, num_agents * (1 + num_tasks)))
-            data_2d_alloc = np.reshape(data['alloc'].flatten(), (1, num_agents * num_tasks))
-            with open(path1, "ab") as f:
-                np.savetxt(f, data_2d_learn, delimiter=',')
-            with open(path2, "ab") as f:
-                np.savetxt(f, data_2d_alloc, delimiter=',')
-        else:
+            for key, writer in writers.items():
+                writer.extend(data[key])
+        elif cmd == 'close':
+            [w.flush() for w in writers.values()]
+            return
+        elif cmd is not None:
             raise NotImplementedError
+        for writer in writers.values():
+            if writer.flush_due():
+                writer.flush()
 
 
 class AsyncWriter:
-    def __init__(self, fname_learning, fname_alloc, num_agents, num_tasks):
+    """
+    Writes the learning curves and the task allocations in a separate process. The rows are
+    written in blocks to data/{fname_learning}.npy and data/{fname_alloc}.npy, see ChunkedWriter,
+    load_chunked and to_csv. The buffered rows are flushed when the writer is closed, at the latest
+    when the interpreter exits.
+
+    write only copies the row into a local block, a block of coalesce rows (or the rows written in
+    the last flush_interval seconds) is sent to the writer process as one message. The messages go
+    through a queue of at most max_pending blocks, when it is full the block is either waited for
+    (policy="block") or dropped and counted in self.dropped (policy="drop"), so a writer which falls
+    behind cannot grow the memory of the training process.
+    """
+
+    def __init__(self, fname_learning, fname_alloc, num_agents, num_tasks, block_size=256, flush_interval=10.0,
+                 coalesce=32, max_pending=64, policy="block"):
+        assert policy in ("block", "drop")
         self.fname_learning = fname_learning
         self.fname_alloc = fname_alloc
         self.path = self.path = \
             os.path.realpath(os.path.join(os.path.dirname(__file__), '..', '..', 'data'))
-        self.abs_fname_learning = f'{self.path}/{self.fname_learning}.csv'
-        self.abs_fname_alloc = f'{self.path}/{self.fname_alloc}.csv'
-        local, remote = Pipe()
-        self.locals = []
-        self.locals.append(local)
+        self.abs_fname_learning = f'{self.path}/{self.fname_learning}.npy'
+        self.abs_fname_alloc = f'{self.path}/{self.fname_alloc}.npy'
+        self.flush_interval = flush_interval
+        self.policy = policy
+        self.dropped = 0  # the number of rows dropped because the queue was full
+        # the rows which have not been sent yet
+        self.blocks = {'learn': np.zeros((coalesce, num_agents * (1 + num_tasks)), dtype=np.float32),
+                       'alloc': np.zeros((coalesce, num_agents * num_tasks), dtype=np.float32)}
+        self.num_rows = 0
+        self.last_send = time.time()
+        self.messages = Queue(maxsize=max_pending)
         # delete the contents of the file before beginning learning and writing
-        open(self.abs_fname_learning, "w").close()
-        open(self.abs_fname_alloc, "w").close()
-        p = Process(target=worker,
-                    args=(remote, self.abs_fname_learning, self.abs_fname_alloc, num_agents, num_tasks))
-        p.daemon = True
-        p.start()
-        remote.close()
+        open(self.abs_fname_learning, "wb").close()
+        open(self.abs_fname_alloc, "wb").close()
+        self.process = Process(target=worker,
+                               args=(self.messages, self.abs_fname_learning, self.abs_fname_alloc, num_agents,
+                                     num_tasks, block_size, flush_interval))
+        self.process.daemon = True
+        self.process.start()
+        atexit.register(self.close)
 
     def write(self, data):
-        self.locals[0].send(('write', data))
+        """:param data: a dictionary of the learn and alloc rows of one iteration"""
+        for key, block in self.blocks.items():
+            block[self.num_rows] = np.ravel(data[key])
+        self.num_rows += 1
+        if self.num_rows == len(self.blocks['learn']) or time.time() - self.last_send >= self.flush_interval:
+            self.send()
+
+    def send(self, block=None):
+        """Sends the local rows to the writer process, block overrides the full queue policy"""
+        if self.num_rows:
+            message = ('write', {key: b[:self.num_rows].copy() for key, b in self.blocks.items()})
+            if block or (block is None and self.policy == "block"):
+                self.messages.put(message)
+            else:
+                try:
+                    self.messages.put_nowait(message)
+                except queue.Full:
+                    self.dropped += self.num_rows
+            self.num_rows = 0
+        self.last_send = time.time()
+
+    def close(self):
+        """Flushes the buffered rows and stops the writer process"""
+        if self.process.is_alive():
+            self.send(block=True)
+            self.messages.put(('close', None))
+            self.process.join()
+
+
+class RunLogger:
+    """
+    Logs the training metrics of each iteration into a run directory:
+        {run_dir}/columns.json  the metric names
+        {run_dir}/metrics.npy   one row per iteration, appended in blocks, see ChunkedWriter
+    The metrics are the frames per second, the collect and update times (seconds), the number of
+    episodes finished in the iteration and in total, percentiles of the env step latencies (milliseconds),
+    the loss of each agent and the task allocation mu.
+
+    An existing run directory is resumed: a partially written block is truncated, and the
+    iteration, episode and elapsed time counters continue from the last complete row.
+    """
+
+    LATENCY_PERCENTILES = (50, 90, 99, 100)
+
+    def __init__(self, run_dir: str, num_agents: int, num_tasks: int, block_size=64, flush_interval=30.0):
+        self.run_dir = run_dir
+        self.columns = ["iteration", "elapsed", "fps", "collect_time", "update_time", "episodes", "total_episodes"] + \
+            [f"step_latency_p{p}" for p in self.LATENCY_PERCENTILES] + \
+            [f"loss_{i}" for i in range(num_agents)] + \
+            [f"mu_{i}_{j}" for i in range(num_agents) for j in range(num_tasks)]
+        self.fname = os.path.join(run_dir, "metrics.npy")
+        os.makedirs(run_dir, exist_ok=True)
+        columns_fname = os.path.join(run_dir, "columns.json")
+        if os.path.exists(columns_fname):
+            with open(columns_fname) as f:
+                if json.load(f) != self.columns:
+                    raise ValueError(f"{run_dir} was logged with different metrics")
+        else:
+            with open(columns_fname, "w") as f:
+                json.dump(self.columns, f)
+        self.iteration, self.total_episodes, elapsed = 0, 0, 0.0
+        if os.path.exists(self.fname):
+            last = recover_chunked(self.fname)
+            if last is not None:
+                self.iteration, elapsed, self.total_episodes = int(last[-1, 0]) + 1, last[-1, 1], int(last[-1, 6])
+        # the elapsed time continues from the resumed run
+        self.start = time.time() - elapsed
+        self.writer = ChunkedWriter(self.fname, len(self.columns), block_size, flush_interval, dtype=np.float64,
+                                    append=True)
+        atexit.register(self.close)
+
+    def log(self, frames: int, collect_time: float, update_time: float, loss, mu, episodes: int,
+            step_latencies: np.ndarray = None):
+        """
+        :param frames: the number of env frames collected in the iteration
+        :param loss: the loss of each agent, shape: (agents,)
+        :param mu: the task allocation, shape: (agents, tasks)
+        :param step_latencies: the env step latencies of the iteration in seconds, any shape
+        """
+        if step_latencies is not None and np.size(step_latencies):
+            latency = np.percentile(step_latencies, self.LATENCY_PERCENTILES) * 1e3
+        else:
+            latency = np.full(len(self.LATENCY_PERCENTILES), np.nan)
+        self.total_episodes += episodes
+        row = np.concatenate([
+            [self.iteration, time.time() - self.start, frames / max(collect_time + update_time, 1e-9),
+             collect_time, update_time, episodes, self.total_episodes],
+            latency, np.ravel(loss), np.ravel(mu)])
+        self.writer.append(row)
+        if self.writer.flush_due():
+            self.writer.flush()
+        self.iteration += 1
+
+    def log_train(self, agent, loss, mu, running_rewards):
+        """Logs an MTARL.train iteration, the times are read from agent.timings and the step latencies
+        from its ParallelEnv"""
+        timings = agent.timings
+        self.log(timings['frames'], timings['collect'], timings['update'], np.asarray(loss), np.asarray(mu),
+                 int(running_rewards.shape[0]), agent.envs.pop_step_latencies())
+
+    def read(self) -> np.ndarray:
+        """The rows logged so far, including the buffered rows"""
+        self.writer.flush()
+        return load_chunked(self.fname)
 
+    def close(self):
+        self.writer.flush()
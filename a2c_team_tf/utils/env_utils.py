@@ -1,8 +1,11 @@
 import gym
 from a2c_team_tf.utils.obs_wrapper import FlatObsWrapper
 
-def make_env(env_key, max_steps_per_episode, seed=None, apply_flat_wrapper=False):
-    env = gym.make(env_key)
+def make_env(env_key, max_steps_per_episode, seed=None, apply_flat_wrapper=False, env_kwargs=None):
+    """
+    :param env_kwargs: keyword arguments for the env constructor, e.g. {'flatten_obs': False} for the team grid envs
+    """
+    env = gym.make(env_key, **(env_kwargs or {}))
     env.seed(seed)
     env.reset()
     if apply_flat_wrapper:
@@ -0,0 +1,119 @@
+# Exports trained agent models as frozen, inference-only graphs with a fixed input signature
+# and loads them back without the training code (MTARL, the nets, the optimiser state)
+
+import os
+import numpy as np
+import tensorflow as tf
+from typing import List, Sequence, Tuple
+
+INPUT_NAME = "observation"
+OUTPUT_NAMES = ("action_logits", "values")
+
+
+def inference_function(model: tf.keras.Model, input_shape: Sequence[int]):
+    """
+    Traces the forward pass of a model for a single fixed input shape
+    :param model: a non-recurrent model returning (action logits, values)
+    :param input_shape: the full input shape, e.g. (1, 1, features) for the MTARL models or (1, features)
+    """
+    @tf.function(input_signature=[tf.TensorSpec(input_shape, tf.float32, name=INPUT_NAME)])
+    def infer(observation):
+        action_logits, values = model(observation)
+        return (tf.identity(tf.cast(action_logits, tf.float32), name=OUTPUT_NAMES[0]),
+                tf.identity(tf.cast(values, tf.float32), name=OUTPUT_NAMES[1]))
+    return infer.get_concrete_function()
+
+
+def freeze(concrete):
+    """
+    Folds the variables captured by a concrete function into constants.
+    convert_variables_to_constants_v2 is not part of the public TensorFlow API (tf.saved_model and the TFLite
+    converter use it internally), it has been in tensorflow.python.framework.convert_to_constants since TF 2.1.
+    It is imported here so that a TensorFlow release which moves it only breaks the .pb export
+    """
+    try:
+        from tensorflow.python.framework.convert_to_constants import convert_variables_to_constants_v2
+    except ImportError as e:
+        raise ImportError(f"TensorFlow {tf.__version__} does not provide convert_variables_to_constants_v2, "
+                          f"the .pb export is unavailable, export with quantize=True instead") from e
+    return convert_variables_to_constants_v2(concrete)
+
+
+def export_frozen(model: tf.keras.Model, input_shape: Sequence[int], path: str, quantize=False) -> str:
+    """
+    Writes the model as a frozen GraphDef (.pb), the variables are folded into constants.
+    With quantize the model is written as a TFLite flatbuffer (.tflite) with dynamic range (int8) weight quantisation.
+    :param path: the output file without extension
+    :return: the written file
+    """
+    concrete = inference_function(model, input_shape)
+    if quantize:
+        # no trackable object, the concrete function already captures the weights. With a Keras 3 model
+        # as the trackable object the quantised model outputs NaN or very large logits. The converter logs a
+        # deprecation warning for this path
+        converter = tf.lite.TFLiteConverter.from_concrete_functions([concrete], None)
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        fname = f"{path}.tflite"
+        with open(fname, "wb") as f:
+            f.write(converter.convert())
+        return fname
+    frozen = freeze(concrete)
+    directory, name = os.path.split(os.path.abspath(f"{path}.pb"))
+    tf.io.write_graph(frozen.graph.as_graph_def(), directory, name, as_text=False)
+    return os.path.join(directory, name)
+
+
+def export_team(models: List[tf.keras.Model], input_shape: Sequence[int], directory: str, quantize=False) -> List[str]:
+    """Exports one frozen graph per agent model as {directory}/agent{i}"""
+    os.makedirs(directory, exist_ok=True)
+    return [export_frozen(m, input_shape, os.path.join(directory, f"agent{i}"), quantize=quantize)
+            for i, m in enumerate(models)]
+
+
+class FrozenPolicy:
+    """
+    Lightweight loader for an exported agent. Observations are numpy arrays of the exported
+    input shape (or anything reshapeable to it) and the outputs are numpy arrays.
+    """
+
+    def __init__(self, path: str):
+        self.tflite = path.endswith(".tflite")
+        if self.tflite:
+            self.interpreter = tf.lite.Interpreter(model_path=path)
+            self.interpreter.allocate_tensors()
+            self.input_index = self.interpreter.get_input_details()[0]["index"]
+            self.input_shape = tuple(self.interpreter.get_input_details()[0]["shape"])
+            # the converter renames the outputs (Identity, Identity_1), they are listed in the returned order
+            self.output_indices = [d["index"] for d in self.interpreter.get_output_details()]
+        else:
+            graph_def = tf.compat.v1.GraphDef()
+            with tf.io.gfile.GFile(path, "rb") as f:
+                graph_def.ParseFromString(f.read())
+            # a dedicated graph and session, a callable created from the session skips the eager
+            # dispatch overhead which dominates the cost of these small graphs
+            graph = tf.Graph()
+            with graph.as_default():
+                tf.compat.v1.import_graph_def(graph_def, name="")
+            self.session = tf.compat.v1.Session(graph=graph)
+            observation = graph.get_tensor_by_name(f"{INPUT_NAME}:0")
+            self.input_shape = tuple(observation.shape)
+            self.function = self.session.make_callable(
+                [graph.get_tensor_by_name(f"{name}:0") for name in OUTPUT_NAMES], feed_list=[observation])
+
+    def __call__(self, observation: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """:return: action logits, values"""
+        observation = np.asarray(observation, dtype=np.float32).reshape(self.input_shape)
+        if self.tflite:
+            self.interpreter.set_tensor(self.input_index, observation)
+            self.interpreter.invoke()
+            return tuple(self.interpreter.get_tensor(i) for i in self.output_indices)
+        action_logits, values = self.function(observation)
+        return action_logits, values
+
+    def act(self, observation: np.ndarray, greedy=True) -> int:
+        """Selects an action for a single observation, the most likely one or a sample from the policy"""
+        action_logits = self(observation)[0].reshape(-1)
+        if greedy:
+            return int(np.argmax(action_logits))
+        p = np.exp(action_logits - action_logits.max())
+        return int(np.random.choice(len(p), p=p / p.sum()))
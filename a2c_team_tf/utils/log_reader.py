@@ -0,0 +1,118 @@
+# Streams training logs and downsamples them without loading the whole file, for logs which are
+# too large to read with pd.read_csv. Reads the chunked .npy files written by ChunkedWriter
+# (AsyncWriter, RunLogger) and the comma separated files written by np.savetxt
+
+import itertools
+import json
+import os
+import numpy as np
+from typing import Dict, Iterator, List
+
+
+class LogReader:
+    """
+    Reads a log of shape (rows, columns) a block of at most chunk_rows rows at a time. Only one
+    block is in memory at once, strided and binned return the downsampled rows.
+    """
+
+    def __init__(self, fname: str, columns: List[str] = None, chunk_rows=65536):
+        """
+        :param fname: a .npy file written by ChunkedWriter (or np.save) or a .csv file
+        :param columns: the column names, used by frame
+        :param chunk_rows: the maximum number of rows read at once
+        """
+        self.fname = fname
+        self.columns = columns
+        self.chunk_rows = chunk_rows
+        self.npy = fname.endswith(".npy")
+
+    @classmethod
+    def from_run(cls, run_dir: str, **kwargs):
+        """Reads the metrics of a RunLogger run directory"""
+        with open(os.path.join(run_dir, "columns.json")) as f:
+            columns = json.load(f)
+        return cls(os.path.join(run_dir, "metrics.npy"), columns, **kwargs)
+
+    def chunks(self, stop: int = None) -> Iterator[np.ndarray]:
+        """Yields consecutive blocks of rows, shape (rows, columns), up to row stop"""
+        blocks = self.npy_chunks() if self.npy else self.csv_chunks()
+        remaining = np.inf if stop is None else stop
+        for block in blocks:
+            if remaining <= 0:
+                return
+            block = block[:int(min(len(block), remaining))]
+            remaining -= len(block)
+            yield block
+
+    def npy_chunks(self) -> Iterator[np.ndarray]:
+        with open(self.fname, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            while f.tell() < size:
+                # the header of each .npy block, the data is then read in slices without loading the block
+                try:
+                    if np.lib.format.read_magic(f) == (1, 0):
+                        shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+                    else:
+                        shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+                except ValueError:
+                    return  # a partially written last block
+                if fortran_order:
+                    raise ValueError("Fortran ordered logs are not supported")
+                rows = shape[0] if shape else 1
+                row_size = int(np.prod(shape[1:])) if len(shape) > 1 else 1
+                if f.tell() + rows * row_size * dtype.itemsize > size:
+                    return
+                for start in range(0, rows, self.chunk_rows):
+                    n = min(self.chunk_rows, rows - start)
+                    yield np.fromfile(f, dtype=dtype, count=n * row_size).reshape(n, row_size)
+
+    def csv_chunks(self) -> Iterator[np.ndarray]:
+        with open(self.fname) as f:
+            while True:
+                lines = list(itertools.islice(f, self.chunk_rows))
+                if not lines:
+                    return
+                yield np.loadtxt(lines, delimiter=',', ndmin=2)
+
+    def num_rows(self) -> int:
+        return sum(len(block) for block in self.chunks())
+
+    def strided(self, step: int, stop: int = None) -> np.ndarray:
+        """Every step-th row, rows 0, step, 2 * step, ... before row stop, like iloc[:stop:step]"""
+        rows, offset = [], 0
+        for block in self.chunks(stop):
+            # copied, a view would keep the whole block alive
+            rows.append(block[(-offset) % step::step].copy())
+            offset += len(block)
+        return np.concatenate(rows) if rows else np.zeros((0, len(self.columns or [])))
+
+    def binned(self, bin_size: int, stop: int = None) -> Dict[str, np.ndarray]:
+        """
+        Downsamples consecutive bins of bin_size rows, the last bin may be smaller
+        :return: the min, max and mean of each bin, and the index of the first row of each bin
+        """
+        stats = {"min": [], "max": [], "mean": []}
+        carry = None
+        for block in self.chunks(stop):
+            if carry is not None:
+                block = np.concatenate([carry, block])
+            full = len(block) // bin_size * bin_size
+            bins = block[:full].reshape(-1, bin_size, block.shape[1])
+            stats["min"].append(bins.min(axis=1))
+            stats["max"].append(bins.max(axis=1))
+            stats["mean"].append(bins.mean(axis=1))
+            carry = block[full:]
+        if carry is not None and len(carry):
+            stats["min"].append(carry.min(axis=0, keepdims=True))
+            stats["max"].append(carry.max(axis=0, keepdims=True))
+            stats["mean"].append(carry.mean(axis=0, keepdims=True))
+        result = {k: np.concatenate(v) for k, v in stats.items() if v}
+        if not result:
+            return {}
+        result["index"] = np.arange(len(result["mean"])) * bin_size
+        return result
+
+    def frame(self, data: np.ndarray, index: np.ndarray = None):
+        """A pandas DataFrame of downsampled rows with the column names, e.g. for plotting"""
+        import pandas as pd
+        return pd.DataFrame(data, columns=self.columns, index=index)
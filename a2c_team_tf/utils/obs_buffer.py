@@ -0,0 +1,58 @@
+# Assembles the model inputs from the environment observations and the xDFA progress
+# The rows are written into a buffer which is allocated once and reused on every step, instead
+# of building them with np.append for every agent on every frame
+
+import numpy as np
+from typing import List, Sequence
+from a2c_team_tf.utils.dfa import CrossProductDFA
+
+
+class ObsAssembler:
+    """
+    Writes [env features, xDFA progress] for each row (usually an agent) into a preallocated
+    buffer of shape (rows, F). The buffer is allocated on the first call, when the feature
+    and progress sizes are known.
+
+    The returned arrays are views of the buffer and are overwritten by the next call, copy them
+    if they have to outlive the step.
+    """
+
+    def __init__(self, num_rows: int, dtype=np.float32):
+        """
+        :param num_rows: the number of observations assembled per call, e.g. the number of agents
+        :param dtype: the buffer dtype
+        """
+        self.num_rows = num_rows
+        self.dtype = dtype
+        self.buffer = None
+        self.obs_size = None
+
+    def allocate(self, obs: np.ndarray, dfa: CrossProductDFA):
+        self.obs_size = np.size(obs)
+        self.buffer = np.zeros((self.num_rows, self.obs_size + len(dfa.progress)), dtype=self.dtype)
+
+    def assemble_row(self, k: int, obs: np.ndarray, dfa: CrossProductDFA, out: np.ndarray = None) -> np.ndarray:
+        """
+        :param k: the row index
+        :param obs: the env observation for the row, it is flattened
+        :param dfa: the xDFA whose progress is appended to the observation
+        :param out: optional (rows, F) array written to instead of the buffer
+        :return: the assembled row of shape (F,)
+        """
+        if self.buffer is None:
+            self.allocate(obs, dfa)
+        buffer = self.buffer if out is None else out
+        buffer[k, :self.obs_size] = np.ravel(obs)
+        buffer[k, self.obs_size:] = dfa.progress
+        return buffer[k]
+
+    def assemble(self, obs: Sequence[np.ndarray], dfas: List[CrossProductDFA], out: np.ndarray = None) -> np.ndarray:
+        """
+        :param obs: one env observation per row
+        :param dfas: one xDFA per row
+        :param out: optional (rows, F) array written to instead of the buffer
+        :return: the assembled observations of shape (rows, F)
+        """
+        for k in range(self.num_rows):
+            self.assemble_row(k, obs[k], dfas[k], out)
+        return self.buffer if out is None else out
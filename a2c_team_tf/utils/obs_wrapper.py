@@ -5,28 +5,66 @@ import numpy as np
 
 class FlatObsWrapper(gym.core.ObservationWrapper):
     """Compatible with gym-minigrid, this wrapper returns a flat fully observable
-    state representation of the environment"""
-    def __init__(self, env, max_steps):
+    state representation of the environment. With flatten_obs=False the encoded
+    (width, height, 3) grid is returned unflattened.
+
+    By default the full grid is encoded on every step. With incremental=True the encoded grid
+    is cached and only the cells an action can change are re-encoded: the agent's old and new
+    cells and the cell in front of the agent (pickup, drop and toggle, e.g. a door opening).
+    Only use it on envs where nothing else changes during a step, it is wrong for envs with
+    moving objects, e.g. MiniGrid-Dynamic-Obstacles."""
+    def __init__(self, env, max_steps, flatten_obs=True, incremental=False):
         super().__init__(env)
+        self.flatten_obs = flatten_obs
+        self.incremental = incremental
+        grid_shape = (self.env.width, self.env.height, 3)
         self.observation_space = spaces.Box(
             low=0,
             high=255,
-            shape=(self.env.width * self.env.height * 3, ),
+            shape=(int(np.prod(grid_shape)), ) if flatten_obs else grid_shape,
             dtype='uint8'
         )
         self.unwrapped.max_steps = max_steps
+        # the encoded grid with the agent drawn in and the cells to re-encode on the next observation
+        self.full_grid = None
+        self.agent_cell = None
+        self.dirty = []
+
+    def reset(self, **kwargs):
+        self.full_grid = None
+        return super().reset(**kwargs)
+
+    def step(self, action):
+        env = self.unwrapped
+        # the cell in front of the agent before the action is the only one pickup, drop and toggle act on
+        self.dirty = [tuple(env.front_pos)]
+        return super().step(action)
+
+    def encode_cell(self, i, j):
+        v = self.unwrapped.grid.get(i, j)
+        if v is None:
+            self.full_grid[i, j] = (OBJECT_TO_IDX['empty'], 0, 0)
+        else:
+            self.full_grid[i, j] = v.encode()
 
     def observation(self, obs):
         # observation is called in the step function
         env = self.unwrapped
-        full_grid = env.grid.encode()
-        full_grid[env.agent_pos[0]][env.agent_pos[1]] = np.array([
+        if self.full_grid is None or not self.incremental:
+            self.full_grid = env.grid.encode()
+        else:
+            for i, j in self.dirty + [self.agent_cell]:
+                self.encode_cell(i, j)
+        self.agent_cell = tuple(env.agent_pos)
+        self.full_grid[self.agent_cell] = (
             OBJECT_TO_IDX['agent'],
             COLOR_TO_IDX['red'],
             env.agent_dir
-        ])
-        flattened_grid = full_grid.flatten()
-        return flattened_grid
+        )
+        # copied, the cached grid is patched in place on the next step
+        if not self.flatten_obs:
+            return self.full_grid.copy()
+        return self.full_grid.flatten()
 
     def render(self, *args, **kwargs):
         """This removes the default visualization of the partially observable field of view."""
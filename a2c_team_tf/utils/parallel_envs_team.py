@@ -1,19 +1,24 @@
 # Implements multiprocessing of environment step and DFA progress
 # The purpose of this is to generate significantly more data for the NN model to learn from
 
+import time
+from collections import deque
 from multiprocessing import Process, Pipe
 from typing import List
 import gym
 import numpy as np
 from a2c_team_tf.utils.dfa import CrossProductDFA, DFA
+from a2c_team_tf.utils.obs_buffer import ObsAssembler
 
 
 def worker(conn, env: gym.Env, one_off_reward, num_agents, n_coeff=1.0, n_coeff2=1.0,
-           seed=None, gamma=0.9, reward_machine=False, shaped_rewards=False):
+           seed=None, gamma=0.9, reward_machine=False, shaped_rewards=False, obs_dtype=np.float32):
+    assembler = ObsAssembler(num_agents, obs_dtype)
     while True:
         cmd, action, dfa = conn.recv() # removed task step count
         dfa: List[CrossProductDFA]
         if cmd == "step":  # Worker step command from Pipe
+            start = time.perf_counter()
             obs, reward, done, info = env.step(action)
             # Compute the DFA progress
             if reward_machine:
@@ -49,8 +54,9 @@ def worker(conn, env: gym.Env, one_off_reward, num_agents, n_coeff=1.0, n_coeff2
             else:
                 done = False
             reward_ = np.array([np.array([agent_reward[i]] + task_rewards[i]) for i in range(num_agents)])
-            obs_ = np.array([np.append(obs[k], dfa[k].progress) for k in range(num_agents)])
-            conn.send((obs_, reward_, done, dfa))  # removed task step count from return tuple
+            obs_ = assembler.assemble(obs, dfa)
+            # the step latency includes the xDFA updates and any reset
+            conn.send((obs_, reward_, done, dfa, time.perf_counter() - start))  # removed task step count from return tuple
         elif cmd == "reset":  # Worker reset command from pipe
             # Reset the environment attached to the worker
             if seed:
@@ -77,7 +83,15 @@ class ParallelEnv(gym.Env):
             seed=None,
             gamma=0.9,
             reward_machine=False,
-            shaped_rewards=False):  # removed max steps from signature
+            shaped_rewards=False,
+            obs_dtype=np.float32,
+            max_latency_records=10000):  # removed max steps from signature
+        """
+        :param max_latency_records: the number of steps whose per env latencies are kept, see pop_step_latencies
+        :param obs_dtype: the dtype of the assembled observations, e.g. np.int8 for the team grid envs
+            whose grid codes (< 128) and xDFA progress (-1 to 2) both fit, which makes the observations
+            sent through the pipes and returned by step 4x smaller than float32
+        """
         self.envs = envs
         self.seed = seed
         self.num_agents = num_agents
@@ -91,18 +105,28 @@ class ParallelEnv(gym.Env):
         self.n2_coeff = normalisation_coef2
         self.reward_machine = reward_machine
         self.shaped_rewards = shaped_rewards
+        # assembles the observations of env 0, the observations of all envs are gathered in obs_buffer
+        self.obs_dtype = obs_dtype
+        self.assembler = ObsAssembler(num_agents, obs_dtype)
+        self.obs_buffer = None
+        # the step latency of every env (seconds), one array of shape (envs,) per step
+        self.step_latencies = deque(maxlen=max_latency_records)
         self.locals = []
         for env in self.envs[1:]:
             local, remote = Pipe()
             self.locals.append(local)
             p = Process(target=worker, args=(remote, env, one_off_reward, num_agents,
-                                             self.n_coeff,self.n2_coeff,seed, gamma, reward_machine, shaped_rewards))
+                                             self.n_coeff,self.n2_coeff,seed, gamma, reward_machine, shaped_rewards,
+                                             obs_dtype))
             p.daemon = True
             p.start()
             remote.close()
 
     def reset(self):
-        """Multiprocessing environment reset method"""
+        """
+        Multiprocessing environment reset method
+        :return: observations of shape (envs, agents, F), the array is reused by step and reset
+        """
         for local, dfa in zip(self.locals, self.dfas[1:]):
             local.send(('reset', None, dfa))
         [d.reset() for d in self.dfas[0]]
@@ -110,15 +134,22 @@ class ParallelEnv(gym.Env):
             self.envs[0].seed(self.seed)
         results = list(zip(*[(self.envs[0].reset(), self.dfas[0])] + [local.recv() for local in self.locals]))
         self.dfas = list(results[1])
-        reset_obs = [np.array(
-            [np.append(result[k], self.dfas[i][k].progress) for k in range(self.num_agents)]
-        ) for i, result in enumerate(results[0])]
-        return np.array(reset_obs, dtype=np.float32)
+        obs_0 = self.assembler.assemble(results[0][0], self.dfas[0])
+        if self.obs_buffer is None:
+            self.obs_buffer = np.zeros((len(self.envs),) + obs_0.shape, dtype=self.obs_dtype)
+        self.obs_buffer[0] = obs_0
+        for i in range(1, len(self.envs)):
+            self.assembler.assemble(results[0][i], self.dfas[i], out=self.obs_buffer[i])
+        return self.obs_buffer
 
     def step(self, actions):
-        """Multiprocessing environment step method, also computes the cross product DFA progress"""
+        """
+        Multiprocessing environment step method, also computes the cross product DFA progress
+        :return: observations (envs, agents, F), which reuses the array returned by reset, rewards and dones
+        """
         for local, action, dfa in zip(self.locals, actions[1:], self.dfas[1:]):
             local.send(("step", action, dfa))
+        start = time.perf_counter()
         obs, reward, done, _ = self.envs[0].step(actions[0])
         if self.reward_machine:
             Phi = [d.Phi[d.statespace_mapping[d.product_state]] for d in self.dfas[0]]
@@ -154,10 +185,20 @@ class ParallelEnv(gym.Env):
         reward_ = np.array([np.array([agent_rewards[i]] + task_rewards[i]) for i in range(self.num_agents)])
         #print("reward ", reward_)
         # Concatenate the environment state and the DFA progress states for each task
-        obs_ = np.array([np.append(obs[k], self.dfas[0][k].progress) for k in range(self.num_agents)])
-        results = list(zip(*[(obs_, reward_, done, self.dfas[0])] + [local.recv() for local in self.locals]))
+        self.assembler.assemble(obs, self.dfas[0], out=self.obs_buffer[0])
+        latency = time.perf_counter() - start
+        results = list(zip(*[(None, reward_, done, self.dfas[0], latency)] + [local.recv() for local in self.locals]))
         self.dfas = list(results[3])
-        return np.array(results[0], dtype=np.float32), np.array(results[1], dtype=np.float32), np.array(results[2], np.int32)
+        self.step_latencies.append(np.array(results[4]))
+        for i in range(1, len(self.envs)):
+            self.obs_buffer[i] = results[0][i]
+        return self.obs_buffer, np.array(results[1], dtype=np.float32), np.array(results[2], np.int32)
+
+    def pop_step_latencies(self) -> np.ndarray:
+        """The step latencies (seconds) recorded since the last call, shape: (steps, envs)"""
+        latencies = np.array(self.step_latencies).reshape(-1, len(self.envs))
+        self.step_latencies.clear()
+        return latencies
 
     def render(self):
         raise NotImplementedError
\ No newline at end of file
@@ -1,6 +1,7 @@
 import matplotlib.pyplot as plt
 import os
-import pandas as pd
+import numpy as np
+from a2c_team_tf.utils.log_reader import LogReader
 
 data = os.path.realpath(os.path.join(os.path.dirname(__file__), '..', '..', 'data'))
 figures = os.path.realpath(os.path.join(os.path.dirname(__file__), '..', '..', 'figures'))
@@ -15,13 +16,30 @@ title_size = 16
 tick_font_size = 12
 ival = 100  # sampling interval
 f_len = 15640
-df = pd.read_csv(f'{data}/{dfname}.csv', delimiter=',', header=None, names=["A1", "A1T1", "A1T2", "A2", "A2T1", "A2T2"])
-df2 = pd.read_csv(f'{data}/{dfname2}.csv', delimiter=',', header=None, names=["A1T1", "A1T2", "A2T1", "A2T2"])
+downsample = "strided"  # every ival-th row, or the "mean", "min" or "max" of each bin of ival rows
+
+
+def read_data(name, columns):
+    """
+    Streams the first f_len rows written by AsyncWriter, data/{name}.npy, or of a legacy csv file
+    and downsamples them, the whole log is never loaded
+    """
+    fname = f'{data}/{name}.npy' if os.path.exists(f'{data}/{name}.npy') else f'{data}/{name}.csv'
+    reader = LogReader(fname, columns)
+    if downsample == "strided":
+        rows = reader.strided(ival, stop=f_len)
+        return reader.frame(rows, index=np.arange(len(rows)) * ival)
+    bins = reader.binned(ival, stop=f_len)
+    return reader.frame(bins[downsample], index=bins["index"])
+
+
+df = read_data(dfname, ["A1", "A1T1", "A1T2", "A2", "A2T1", "A2T2"])
+df2 = read_data(dfname2, ["A1T1", "A1T2", "A2T1", "A2T2"])
 fig, axes = plt.subplots(nrows=1, ncols=4, figsize=(15, 4))
-df.iloc[:f_len:ival, :].filter(items=['A1', 'A2']).plot(ax=axes[0])
-df2.iloc[:f_len:ival, :].filter(items=["A1T1", "A1T2"]).plot(ax=axes[1])
-df2.iloc[:f_len:ival, :].filter(items=["A2T1", "A2T2"]).plot(ax=axes[2])
-df.iloc[:f_len:ival, :].filter(items=['A1T1', 'A2T2']).plot(ax=axes[3])
+df.filter(items=['A1', 'A2']).plot(ax=axes[0])
+df2.filter(items=["A1T1", "A1T2"]).plot(ax=axes[1])
+df2.filter(items=["A2T1", "A2T2"]).plot(ax=axes[2])
+df.filter(items=['A1T1', 'A2T2']).plot(ax=axes[3])
 axes[0].set_xlabel('Batch Frames', size=title_size)
 axes[0].set_ylabel('Avg Reward', size=title_size)
 axes[0].set_title(f'{title1}', size=title_size)
@@ -0,0 +1,156 @@
+# Records evaluation episodes off-screen in a background process, instead of rendering them in a
+# window from the training loop. The models are snapshotted as frozen graphs (see export.py) and a
+# forked process runs the episode with the frozen policies, so training carries on while it runs.
+# The episodes are written as npz files of state traces (observations, actions, xDFA progress)
+# and optionally rgb_array frames
+
+import os
+import copy
+from multiprocessing import Process
+from typing import List, Sequence
+import numpy as np
+import tensorflow as tf
+from a2c_team_tf.utils.export import export_team, FrozenPolicy
+from a2c_team_tf.utils.obs_buffer import ObsAssembler
+
+
+def select_actions(action_logits: np.ndarray, greedy=False) -> np.ndarray:
+    """
+    :param action_logits: shape (agents, actions)
+    :return: the most likely or a sampled action of each agent, shape (agents,)
+    """
+    if greedy:
+        return np.argmax(action_logits, axis=-1)
+    p = np.exp(action_logits - action_logits.max(axis=-1, keepdims=True))
+    p /= p.sum(axis=-1, keepdims=True)
+    return np.array([np.random.choice(p.shape[-1], p=p_) for p_ in p])
+
+
+def policy_logits(policies: List[FrozenPolicy], obs: np.ndarray) -> np.ndarray:
+    """Action logits (agents, actions) of one policy per agent, or of a single policy for all agents"""
+    if len(policies) == 1:
+        return policies[0](obs)[0].reshape(obs.shape[0], -1)
+    return np.stack([p(obs[i])[0].reshape(-1) for i, p in enumerate(policies)])
+
+
+def team_episode(env, dfas, policies: List[FrozenPolicy], max_steps, frames=False, greedy=False, seed=None):
+    """
+    An MTARL episode, all of the agents act in one team env
+    :param dfas: one xDFA per agent
+    """
+    if seed:
+        env.seed(seed)
+    state = env.reset()
+    [d.reset() for d in dfas]
+    assembler = ObsAssembler(len(dfas))
+    trace = {"observations": [assembler.assemble(state, dfas).copy()], "actions": [],
+             "progress": [[d.progress for d in dfas]], "frames": []}
+    for _ in range(max_steps):
+        if frames:
+            trace["frames"].append(env.render(mode='rgb_array'))
+        actions = select_actions(policy_logits(policies, trace["observations"][-1]), greedy)
+        state, _, _, _ = env.step(actions)
+        [d.next({'env': env, 'word': None, 'action': actions}) for d in dfas]
+        trace["observations"].append(assembler.assemble(state, dfas).copy())
+        trace["actions"].append(actions)
+        trace["progress"].append([d.progress for d in dfas])
+        if all(d.done() for d in dfas):
+            break
+    return trace
+
+
+def multi_env_episode(envs, dfas, policies: List[FrozenPolicy], max_steps, frames=False, greedy=False, seed=None):
+    """
+    A lib_mult_env.Agent episode, each agent acts in its own env. The agents which finished their
+    tasks are no longer stepped and repeat their last observation
+    """
+    states = []
+    for env, dfa in zip(envs, dfas):
+        if seed:
+            env.seed(seed)
+        states.append(env.reset())
+        dfa.reset()
+    assembler = ObsAssembler(len(dfas))
+    active = np.ones(len(envs), dtype=bool)
+    trace = {"observations": [assembler.assemble(states, dfas).copy()], "actions": [],
+             "progress": [[d.progress for d in dfas]], "frames": []}
+    for _ in range(max_steps):
+        if frames:
+            trace["frames"].append(np.stack([env.render(mode='rgb_array') for env in envs]))
+        actions = select_actions(policy_logits(policies, trace["observations"][-1]), greedy)
+        for i in np.flatnonzero(active):
+            state, reward, done, _ = envs[i].step(actions[i])
+            dfas[i].next({"state": state, "reward": reward, "done": done})
+            assembler.assemble_row(i, state, dfas[i])
+            active[i] = not dfas[i].done()
+        trace["observations"].append(assembler.buffer.copy())
+        trace["actions"].append(actions)
+        trace["progress"].append([d.progress for d in dfas])
+        if not active.any():
+            break
+    return trace
+
+
+def recorder_worker(episode_fn, paths: List[str], fname: str, envs, dfas, max_steps, kwargs):
+    policies = [FrozenPolicy(p) for p in paths]
+    trace = episode_fn(envs, dfas, policies, max_steps, **kwargs)
+    if not trace["frames"]:
+        trace.pop("frames")
+    np.savez_compressed(fname, **{k: np.asarray(v) for k, v in trace.items()})
+
+
+class EpisodeRecorder:
+    """
+    Records episodes in the background without blocking training. Only one recording runs at a time,
+    record returns False and skips the episode if the previous recording is still running.
+
+    The frozen policies only support non-recurrent models.
+    """
+
+    def __init__(self, directory: str, frames=False, greedy=False, seed=None):
+        """
+        :param directory: where the model snapshots and the episodes, {directory}/{name}.npz, are written
+        :param frames: also record rgb_array renders of the env, otherwise only the state traces
+        :param greedy: act with the most likely action instead of sampling from the policy
+        """
+        self.directory = directory
+        self.frames = frames
+        self.greedy = greedy
+        self.seed = seed
+        self.process = None
+        os.makedirs(directory, exist_ok=True)
+
+    @property
+    def busy(self) -> bool:
+        return self.process is not None and self.process.is_alive()
+
+    def snapshot(self, models: Sequence[tf.keras.Model], input_shape: Sequence[int]) -> List[str]:
+        """Freezes the current weights of the models"""
+        return export_team(list(models), input_shape, os.path.join(self.directory, "snapshot"))
+
+    def record(self, episode_fn, envs, dfas, models: Sequence[tf.keras.Model], input_shape: Sequence[int],
+               name: str, max_steps: int) -> bool:
+        """
+        :param episode_fn: team_episode or multi_env_episode
+        :param envs: the env (team_episode) or the envs (multi_env_episode) to run the episode in,
+            they are copied into the recording process and are not changed
+        :param input_shape: the model input shape of a single observation
+        :return: whether the recording was started
+        """
+        if self.busy:
+            return False
+        if self.process is not None:
+            self.process.join()
+        paths = self.snapshot(models, input_shape)
+        fname = os.path.join(self.directory, f"{name}.npz")
+        self.process = Process(target=recorder_worker, args=(
+            episode_fn, paths, fname, envs, copy.deepcopy(dfas), max_steps,
+            {'frames': self.frames, 'greedy': self.greedy, 'seed': self.seed}))
+        self.process.daemon = True
+        self.process.start()
+        return True
+
+    def join(self):
+        """Waits for the running recording to finish"""
+        if self.process is not None:
+            self.process.join()
@@ -8,7 +8,8 @@ from a2c_team_tf.lib.tf2_a2c_base_v2 import MTARL
 from a2c_team_tf.utils.dfa import DFAStates, DFA, CrossProductDFA, RewardMachines, RewardMachine
 from abc import ABC
 from a2c_team_tf.utils.env_utils import make_env
-from a2c_team_tf.utils.data_capture import AsyncWriter
+from a2c_team_tf.utils.data_capture import AsyncWriter, RunLogger
+from a2c_team_tf.utils.recorder import EpisodeRecorder
 import multiprocessing
 
 env_key = 'DualDoors-v0'
@@ -566,6 +567,10 @@ data_writer = AsyncWriter(
     fname_alloc='data-maze-ma-alloc',
     num_agents=num_agents,
     num_tasks=num_tasks)
+# evaluation episodes are recorded off-screen to data/episodes-maze-ma/batch{i}.npz
+recorder = EpisodeRecorder('data/episodes-maze-ma', seed=seed)
+# throughput, timing, loss and allocation metrics, resumed if the run directory exists
+run_logger = RunLogger('runs/maze-ma', num_agents, num_tasks)
 
 
 #############################################################################
@@ -586,6 +591,7 @@ with tqdm.trange(max_episodes) as t:
     print("mu ", mu)
     for i in t:
         state, log_reward, running_reward, loss, ini_values = agent.train(state, log_reward, indices, mu, *models)
+        run_logger.log_train(agent, loss, mu, running_reward)
         #if i % 10 == 0:
         #     with tf.GradientTape() as tape:
         #         mu = tf.nn.softmax(kappa, axis=0)
@@ -603,11 +609,8 @@ with tqdm.trange(max_episodes) as t:
             data_writer.write({'learn': running_reward, 'alloc': mu.numpy()})
             t.set_postfix(running_r=running_reward)
         if i % 200 == 0:
-            # render an episode
-            r_init_state = agent.render_reset()
-            r_init_state = tf.expand_dims(tf.expand_dims(r_init_state, 1), 2)
-            agent.render_episode(r_init_state, max_epsiode_steps, *models)
-            # agent.renv.window.close()
+            # record an episode in the background, training continues while it runs
+            agent.record_episode(recorder, f"batch{i}", max_epsiode_steps, *models)
         ### Define break clause
         if episodes_reward:
             running_tasks = np.reshape(running_reward, [num_agents, num_tasks + 1])